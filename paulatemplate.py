@@ -3,61 +3,508 @@
 # TODO: { } to « »  (MacOS: Alt-\ and Shift-Alt-\)
 # TODO: 100% coverage
 # TODO: spotless unittests
-# TODO: be able to access members in template vars: {=person.lastname}
 # TODO: with tokens and Lits and Conds etc, store the line/charpos of the position in the template for better error messages
 # TODO: String-only mode
 # TODO: In Python3, test performance again with A) StringIO, B) concat fest, C) lines.append() method
 
+import array
+import asyncio
+import builtins
+import hashlib
+import html
+import importlib.util
+import inspect
+import marshal
 import os
+import pickle
 import pprint
 import re
+import struct
+import sys
+import tempfile
 import unittest
 import codecs
+import collections
+import collections.abc
+import contextlib
+import copy
+import fnmatch
 import functools
+import itertools
+import operator
+import threading
+import time
+
+__version__ = "0.2.0"
 
 CHOPNAME = 1
 CHOPITEM = 2
+CHOPOPTIONS = 3
 
 whitechars = re.compile("\s")
 rangerep = re.compile("(\w+)\:(-?[0-9|x]+):(-?[0-9|x]+)")
 
-verbose = True
-exceptionless = True  # False: throw exceptions when something is wrong with the template or rendering it; True: insert an error in the output text instead.
+class Markup(str):
+    """Text that is safe to put into HTML as it is. Autoescaping leaves it alone, like anything else with
+    an __html__() method (such as markupsafe.Markup)."""
+    __slots__ = ()
+
+    def __html__(self):
+        return self
+
+
+def _escaped(value):
+    """The output text for a substituted value when autoescaping: HTML-escaped, unless it's markup."""
+    if hasattr(value, "__html__"):
+        return value.__html__()
+    value = _text(value)
+    return html.escape(value) if isinstance(value, str) else value
+
+
+def _text(value):
+    "Convert a substituted value to output text, the way Sub.render does."
+    if isinstance(value, (int, float)):
+        return str(value)
+    if value is None:
+        return ""
+    return value
+
+
+_MISSING = object()
+
+
+_LOOKUPERRORS = (KeyError, IndexError, AttributeError)  # What a failing Accessor raises.
+
+
+class _Step(object):
+    """One step of an Accessor: a key, attribute or integer index. Which one works is found out on first use
+    for each type of value it's applied to, and remembered as an operator.itemgetter or operator.attrgetter."""
+    __slots__ = ("key", "getters")
+
+    def __init__(self, key):
+        self.key = key
+        self.getters = {}  # type -> getter
+
+    def __call__(self, value):
+        getter = self.getters.get(value.__class__) or self.learn(value)
+        return getter(value)
+
+    def learn(self, value):
+        key = self.key
+        if key.lstrip("-").isdigit() and not isinstance(value, collections.abc.Mapping):
+            key = int(key)
+        try:
+            value[key]
+            getter = operator.itemgetter(key)
+        except (KeyError, IndexError):
+            getter = operator.itemgetter(key)  # It's a container, that just doesn't have this key.
+        except TypeError:
+            getter = operator.attrgetter(self.key)
+        self.getters[value.__class__] = getter
+        return getter
+
+
+class Accessor(object):
+    """Looks up a variable name in the template variables. The name can be a dotted path like "person.lastname"
+    or "rows.0.title", of which every part is a dictionary key, an attribute, or an index into a sequence.
+    Calling an Accessor raises one of _LOOKUPERRORS when a part of the path isn't there; the other methods
+    return _MISSING (or a default) instead."""
+    __slots__ = ("path", "head", "steps")
+
+    def __init__(self, path):
+        self.path = path
+        self.head = path.split(".", 1)[0]
+        self.steps = tuple(_Step(part) for part in path.split("."))
+
+    def __call__(self, vars):
+        for step in self.steps:
+            vars = step(vars)
+        return vars
+
+    def __reduce__(self):
+        return (Accessor, (self.path,))
+
+    def probe(self, vars):
+        """Look up the first part of the path in the variables of one scope."""
+        if vars.__class__ is dict:
+            return vars.get(self.head, _MISSING)
+        try:
+            return self.steps[0](vars)
+        except _LOOKUPERRORS:
+            return _MISSING
+
+    def find(self, scopes):
+        """Look up the first part of the path in the innermost of the scopes (innermost first) that has it."""
+        for vars in scopes:
+            value = self.probe(vars)
+            if value is not _MISSING:
+                return value
+        return _MISSING
+
+    def follow(self, value):
+        """Look up the rest of the path in the value of its first part."""
+        try:
+            for step in self.steps[1:]:
+                value = step(value)
+        except _LOOKUPERRORS:
+            return _MISSING
+        return value
+
+    def lookup(self, vars, default=_MISSING):
+        """Look up the path in 'vars', which can also be a Scope."""
+        value = vars.head(self) if vars.__class__ is Scope else self.probe(vars)
+        if value is not _MISSING and len(self.steps) > 1:
+            value = self.follow(value)
+        return default if value is _MISSING else value
+
+    async def alookup(self, vars, default=_MISSING):
+        """Like lookup(), but awaits every awaitable value along the path."""
+        value = await _awaited(vars.head(self) if vars.__class__ is Scope else self.probe(vars))
+        try:
+            for step in self.steps[1:] if value is not _MISSING else ():
+                value = await _awaited(step(value))
+        except _LOOKUPERRORS:
+            return default
+        return default if value is _MISSING else value
+
+
+class Loop(object):
+    """The state of the current iteration of a Rep, available in its body as {=loop.index} (counting from 1),
+    {=loop.index0} (counting from 0), {?loop.first ...} and {?loop.last ...}."""
+    __slots__ = ("index0", "last")
+
+    def __init__(self):
+        self.index0 = 0
+        self.last = False
 
+    @property
+    def index(self):
+        return self.index0 + 1
 
-def indent(level):
-    return "| " + "    " * level
+    @property
+    def first(self):
+        return self.index0 == 0
+
+
+class Scope(object):
+    """The variables of the template, or of the current item of a Rep, when rendering with the tree interpreter.
+    Names that aren't in these variables are looked up in the enclosing scope ('parent'). 'loop' is the Loop
+    of the Rep that made the scope. During async rendering, 'tasks' has the tasks for the awaitable variables."""
+    __slots__ = ("vars", "parent", "loop", "tasks")
+
+    def __init__(self, vars, parent=None, loop=None, tasks=None):
+        self.vars = vars
+        self.parent = parent
+        self.loop = loop
+        self.tasks = tasks
+
+    def __repr__(self):
+        return repr(self.vars)
+
+    def head(self, accessor):
+        """Look up the first part of the Accessor's path in the innermost scope that has it. In the body of a Rep,
+        'loop' is the Loop of the innermost Rep, unless its current item has a 'loop' of its own."""
+        scope = self
+        if accessor.head == "loop":
+            while scope is not None:
+                if scope.loop is not None:
+                    if scope.tasks and "loop" in scope.tasks:
+                        return scope.tasks["loop"]
+                    value = accessor.probe(scope.vars)
+                    return value if value is not _MISSING else scope.loop
+                scope = scope.parent
+            scope = self
+        while scope is not None:
+            if scope.tasks and accessor.head in scope.tasks:
+                return scope.tasks[accessor.head]
+            value = accessor.probe(scope.vars)
+            if value is not _MISSING:
+                return value
+            scope = scope.parent
+        return _MISSING
+
+    def cancel(self):
+        """Cancel the tasks that no node awaited."""
+        for task in (self.tasks or {}).values():
+            task.cancel()
+
+
+def _errorspan(nodetype, name):
+    return '<span class="paulatemplate_error" style="background-color: red; color: white;">Template error in %s: unknown variable "%s"</span>' % (nodetype, name)
+
+
+def _asyncscope(vars, accessors, parent=None, loop=None):
+    """Make the Scope for async rendering a container, with a task for every awaitable variable that it uses, also
+    from inside nested Reps: 'accessors' has an Accessor for each of its allnames(). The tasks can be awaited by every
+    node that uses the variable, and all of them run concurrently."""
+    tasks = {}
+    for accessor in accessors:
+        value = accessor.probe(vars)
+        if inspect.isawaitable(value):
+            tasks[accessor.head] = asyncio.ensure_future(value)
+    return Scope(vars, parent, loop, tasks)
+
+
+async def _awaited(value):
+    return (await value) if inspect.isawaitable(value) else value
+
+
+def _lookahead(iterable):
+    """Iterate lazily over any iterable, yielding (item, last) pairs. Looks one item ahead to know which is the last."""
+    iterator = iter(iterable)
+    for item in iterator:
+        for nextitem in iterator:
+            yield item, False
+            item = nextitem
+        yield item, True
+
+
+async def _alookahead(iterable):
+    """Iterate over an async or a regular iterable, yielding (item, last) pairs."""
+    if hasattr(iterable, "__aiter__"):
+        iterator = iterable.__aiter__()
+        try:
+            item = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        while True:
+            try:
+                nextitem = await iterator.__anext__()
+            except StopAsyncIteration:
+                yield item, True
+                return
+            yield item, False
+            item = nextitem
+    else:
+        for item, last in _lookahead(iterable):
+            yield item, last
+
+
+@functools.lru_cache(maxsize=256)
+def _rowfiller(names):
+    """Return a generator function that iterates over the zipped columns 'names', yielding (row, last) pairs
+    like _lookahead(), with the values of every row assigned into the same dict."""
+    targets = "".join("row[%r], " % name for name in names)
+    source = ("def pairs(row, columns, last):\n"
+              "    for index, (%s) in enumerate(zip(*columns)):\n"
+              "        yield row, index == last\n" % targets)
+    namespace = {}
+    exec(source, namespace)
+    return namespace["pairs"]
+
+
+class Columns(object):
+    """A source of rows for a Rep in columnar form: a mapping of column names to sequences of values, all of the same
+    length, e.g. lists or NumPy arrays. {#rows ...} with rows=Columns(dict(id=ids, name=names)) renders its body for
+    every row, in which {=id} is ids[i], without making a dict for each row: the body sees every row in the same dict,
+    which is updated from row to row. The columns that the body only substitutes are converted to text in advance, all
+    at once (vectorized for NumPy arrays of numbers, and in C for lists of numbers). Iterating over Columns in Python,
+    e.g. when rendering async, does make a new dict for every row."""
+
+    def __init__(self, columns):
+        self.columns = columns
+        lengths = set(len(column) for column in columns.values())
+        if len(lengths) > 1:
+            raise ValueError("The columns have different lengths: %s" % ", ".join("%s=%d" % (name, len(column))
+                                                                                 for name, column in columns.items()))
+        self.length = lengths.pop() if lengths else 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        columns = self.prepare()
+        for index in range(self.length):
+            yield dict((name, column[index]) for name, column in columns.items())
+
+    def prepare(self, textnames=()):
+        """Return the columns with NumPy arrays as lists, and the columns 'textnames' converted to text the way Sub does."""
+        columns = {}
+        for name, column in self.columns.items():
+            if hasattr(column, "astype") and hasattr(column, "tolist"):  # A NumPy array, without importing NumPy.
+                if name in textnames and getattr(column.dtype, "kind", None) in ("b", "i", "u", "f"):
+                    columns[name] = column.astype(str).tolist()
+                    continue
+                column = column.tolist()
+            if name in textnames:
+                types = set(map(type, column))
+                if types <= {int, float, bool}:
+                    column = list(map(str, column))
+                elif not types <= {str}:
+                    column = [_text(value) for value in column]
+            columns[name] = column
+        return columns
+
+    def pairs(self, textnames=()):
+        """Iterate over the rows, yielding (row, last) pairs like _lookahead(). The row is always the same dict,
+        with the values of the next row every time."""
+        columns = self.prepare(textnames)
+        return _rowfiller(tuple(columns))({}, columns.values(), self.length - 1)
+
+
+class Variable(object):
+    """A template variable in the schema from Container.variables(), with how the template uses it ('kind'):
+
+        scalar      substituted: {=name}
+        iterated    repeated over: {#name ...}
+        object      looked into with a dotted path: {=name.key}
+        tested      only tested, {?name ...}, or the key of a {%...} block, so it may be missing
+
+    A variable used in several ways has the kind that comes last in this list but first in Variable.kinds.
+    'children' has the Variables of the dotted paths into it, and 'items' those of the names in the body of
+    a Rep over it (which can also come from the enclosing scopes). A variable that is only used in the bodies
+    of Conds is 'guarded': whether rendering needs it depends on the conditions."""
+    __slots__ = ("name", "kind", "children", "items", "guarded")
+    kinds = ("tested", "scalar", "object", "iterated")
+
+    def __init__(self, name, kind="tested"):
+        self.name = name
+        self.kind = kind
+        self.children = {}
+        self.items = {}
+        self.guarded = True  # Until a use outside of a Cond.
+
+    def __repr__(self):
+        parts = [self.kind]
+        if self.guarded:
+            parts.append("guarded")
+        if self.children:
+            parts.append("children=%r" % sorted(self.children.values(), key=lambda variable: variable.name))
+        if self.items:
+            parts.append("items=%r" % sorted(self.items.values(), key=lambda variable: variable.name))
+        return "%s: %s" % (self.name, " ".join(parts))
+
+    def use(self, kind, guarded=False):
+        """Record another use of the variable, in the body of a Cond when 'guarded'."""
+        if self.kinds.index(kind) > self.kinds.index(self.kind):
+            self.kind = kind
+        self.guarded = self.guarded and guarded
+
+    @property
+    def required(self):
+        """Whether rendering needs the variable: it's substituted or iterated outside of Conds, or something in it is."""
+        if self.guarded:
+            return False
+        return self.kind in ("scalar", "iterated") or any(child.required for child in self.children.values())
+
+
+def _addvariable(schema, path, kind, guarded=False):
+    """Record the use of the dotted path 'path' in the 'schema' dict, and return the Variable of its last part."""
+    parts = path.split(".")
+    for part in parts[:-1]:
+        variable = schema.setdefault(part, Variable(part))
+        variable.use("object", guarded)
+        schema = variable.children
+    variable = schema.setdefault(parts[-1], Variable(parts[-1]))
+    variable.use(kind, guarded)
+    return variable
 
 
 class Container(list):
     "Generic container."
+    __slots__ = ("name", "line", "col")
 
     def __init__(self, name=""):
         self.name = name
+        self.line = None  # Position of the node in the template source, when known.
+        self.col = None
 
     def __repr__(self):
         tag = "%s %s" % (self.__class__.__name__, self.name)
         return "%s: %s" % (tag.strip(), super(Container, self).__repr__())
 
-    def render(self, vars, last=False, level=0):
-        if verbose:
-            print(f"{indent(level)}Container.render(vars={vars},last={last}) type(vars)={type(vars)}, self.name={self.name}.")
-        output = ""
+    def label(self):
+        """Short description of the node for traces and profiles: its type, name and source position."""
+        position = "%d:%d" % (self.line, self.col) if self.line else "-"
+        return ("%s %s %s" % (position, self.__class__.__name__, self.name)).strip()
+
+    def render(self, vars, last=False, tracer=None):
+        return "".join(self.iter_render(vars, last, tracer))
+
+    def iter_render(self, vars, last=False, tracer=None):
+        """Yield the output of this node in chunks. A Tracer, when given, is notified of every node that renders."""
+        return self.iter_children(vars, last, tracer)
+
+    def iter_children(self, vars, last, tracer):
+        if tracer is None:
+            for child in self:
+                yield from child.iter_render(vars, last)
+        else:
+            for child in self:
+                yield from tracer.trace(child, vars, last)
+
+    async def aiter_render(self, vars, last=False):
+        """Async version of iter_render(), for variables with awaitable values and Reps over async iterables."""
         for child in self:
-            if verbose:
-                print(f"{indent(level)}Container.render child {child}")
-            value = child.render(vars, last, level + 1)
-            if value:
-                try:
-                    output += value
-                except UnicodeDecodeError as e:
-                    msg = f"Container.render() child {child.__class__.__name__} raises {e}, value: {type(value)}, {repr(value)}"
-                    raise Exception(msg)
-        return output
+            async for chunk in child.aiter_render(vars, last):
+                yield chunk
+
+    def scopenames(self):
+        """The names of the variables that the nodes in this container look up, not counting those inside nested Reps."""
+        names = set()
+        stack = list(self)
+        while stack:
+            node = stack.pop()
+            names.update(node.ownnames())
+            if not isinstance(node, (Rep, Lit)):
+                stack.extend(node)
+        return names
+
+    def allnames(self):
+        """The names of all the variables that the nodes in this container look up, including those inside nested Reps."""
+        names = set()
+        stack = list(self)
+        while stack:
+            node = stack.pop()
+            names.update(node.ownnames())
+            if not isinstance(node, Lit):
+                stack.extend(node)
+        return names
+
+    def ownnames(self):
+        """The names of the variables that this node itself looks up."""
+        return ()
+
+    def variables(self):
+        """The schema of the variables that the nodes in this container use: a dict of names to Variables.
+        The names in the body of a Rep are in the 'items' of the Variable of the Rep. The loop variable is left out."""
+        schema = {}
+        stack = [(node, schema, False, False) for node in reversed(self)]
+        while stack:
+            node, scope, inrep, guarded = stack.pop()
+            if isinstance(node, Lit):
+                continue
+            if isinstance(node, Fragment):
+                for accessor in node.keys:
+                    if not (inrep and accessor.head == "loop"):
+                        _addvariable(scope, accessor.path, "tested", guarded)
+            elif isinstance(node, (Sub, Cond, Rep)):
+                kind = "scalar" if isinstance(node, Sub) else "tested" if isinstance(node, Cond) else "iterated"
+                if inrep and node.accessor.head == "loop":
+                    variable = Variable(node.accessor.path, kind)  # Not part of the schema.
+                else:
+                    variable = _addvariable(scope, node.accessor.path, kind, guarded)
+                if isinstance(node, Rep):
+                    scope = variable.items
+                    inrep = True
+                elif isinstance(node, Cond):
+                    guarded = True
+            stack.extend((child, scope, inrep, guarded) for child in reversed(node))
+        return schema
+
+    def dependencies(self):
+        """The names of the variables that the output of this node depends on."""
+        return self.allnames().union(self.ownnames())
+
+    def gencode(self, gen):
+        """Emit Python source for this node into the CodeGen 'gen'."""
+        for child in self:
+            child.gencode(gen)
 
 
 class Lit(Container):
     "Container for literal content."
+    __slots__ = ()
 
     def __init__(self, contents=""):
         super(Lit, self).__init__()
@@ -66,16 +513,35 @@ class Lit(Container):
     def __repr__(self):
         return super(Lit, self).__repr__()
 
-    def render(self, vars, last=None, level=0):
-        if verbose:
-            print("%sLit.render(vars=%s,last=%s) type(vars)=%s, self=%s" % (indent(level), vars, last, type(vars), self))
+    def scopenames(self):
+        return set()
+
+    def allnames(self):
+        return set()
+
+    def label(self):
+        text = self[0] if len(self[0]) <= 20 else self[0][:17] + "..."
+        return "%s %r" % (super(Lit, self).label(), text)
+
+    def render(self, vars, last=False, tracer=None):
         return self[0]
 
+    def iter_render(self, vars, last=False, tracer=None):
+        if self[0]:
+            yield self[0]
 
+    async def aiter_render(self, vars, last=False):
+        if self[0]:
+            yield self[0]
+
+    def gencode(self, gen):
+        if self[0]:
+            gen.emit("yield %r" % self[0])
 
 
 class Sep(Container):
     "Container for separator. Same as Lit, but doesn't result in output in the last iteration of a Rep."
+    __slots__ = ()
 
     def __init__(self, name):
         super(Sep, self).__init__(name)
@@ -83,108 +549,402 @@ class Sep(Container):
     def __repr__(self):
         return super(Sep, self).__repr__()
 
-    def render(self, vars, last, level):
-        if verbose:
-            print("%sSep.render(vars=%s) type(vars)=%s, self=%s" % (indent(level), vars, type(vars), self))
+    def iter_render(self, vars, last=False, tracer=None):
         if last:
-            if verbose:
-                print("%sSep.render last is True, empty string returned" % indent(level))
-            return ""
-        output = ""
-        for child in self:
-            if verbose:
-                print("%sSep.render child %s" % (indent(level), child))
-            value = child.render(vars, last, level + 1)
-            if value:
-                output += value
-        return output
+            return
+        yield from self.iter_children(vars, last, tracer)
+
+    async def aiter_render(self, vars, last=False):
+        if last:
+            return
+        async for chunk in super(Sep, self).aiter_render(vars, last):
+            yield chunk
+
+    def gencode(self, gen):
+        gen.emit("if not last%d:" % gen.depth)
+        with gen.block():
+            super(Sep, self).gencode(gen)
 
 
 class Sub(Container):
-    "Container for a variable substitution."
+    """Container for a variable substitution. With 'escape' (set when compiling with autoescape)
+    the value is HTML-escaped, unless it's Markup."""
+    __slots__ = ("accessor", "escape")
 
     def __init__(self, name):
         super(Sub, self).__init__(name)
+        self.accessor = Accessor(name)
+        self.escape = False
 
     def __repr__(self):
-        return super(Sub, self).__repr__()
+        return super(Sub, self).__repr__() + (" (escaped)" if self.escape else "")
 
-    def render(self, vars, last, level):
-        if verbose:
-            print("%sSub.render(vars=%s) type(vars)=%s, self.name=%s" % (indent(level), vars, type(vars), self.name))
-        try:
-            value = vars[self.name]
-        except TypeError:
-            value = getattr(vars, self.name)
-        except KeyError:
-            return '<span class="paulatemplate_error" style="background-color: red; color: white;">Template error in Sub: unknown variable "%s"</span>' % self.name
+    def ownnames(self):
+        return (self.accessor.head,)
+
+    def render(self, vars, last=False, tracer=None):
+        value = self.accessor.lookup(vars)
+        if value is _MISSING:
+            return _errorspan("Sub", self.name)
+        if self.escape:
+            return _escaped(value)
         if isinstance(value, (int, float)):
             value = str(value)
         return value
 
+    def iter_render(self, vars, last=False, tracer=None):
+        value = _text(self.render(vars, last))
+        if value:
+            yield value
+
+    async def aiter_render(self, vars, last=False):
+        value = await self.accessor.alookup(vars)
+        if value is _MISSING:
+            value = _errorspan("Sub", self.name)
+        else:
+            value = _escaped(value) if self.escape else _text(value)
+        if value:
+            yield value
+
+    def gencode(self, gen):
+        strict = gen.strict and not (self.accessor.head == "loop" and gen.depth > 0)
+        if self.escape:
+            gen.lookup(self.accessor, "_x", None if strict else gen.constant("Markup(%r)" % _errorspan("Sub", self.name)))
+            gen.emit("_x = _htmlescape(_x) if _x.__class__ is str else _escaped(_x)")
+        else:
+            gen.lookup(self.accessor, "_x", None if strict else repr(_errorspan("Sub", self.name)))
+            gen.emit("if _x.__class__ is not str:")
+            gen.emit("    _x = _text(_x)")
+        gen.emit("if _x:")
+        gen.emit("    yield _x")
+
 
 class Cond(Container):
     "Container for conditional content."
+    __slots__ = ("inverting", "accessor")
 
     def __init__(self, name, inverting=False):
         super(Cond, self).__init__(name)
         self.inverting = inverting
+        self.accessor = Accessor(name)
 
     def __repr__(self):
-        return super(Cond, self).__repr__()
+        return super(Cond, self).__repr__() + (" (inverted)" if self.inverting else "")
+
+    def ownnames(self):
+        return (self.accessor.head,)
 
-    def render(self, vars, last, level):
-        if verbose:
-            print("%sCond.render(vars=%s) type(vars)=%s, self.name=%s, self.inverting=%s" % (indent(level), vars, type(vars), self.name, self.inverting))
-        ok = vars.get(self.name)  # Assume missing template variable is False.
+    def iter_render(self, vars, last=False, tracer=None):
+        ok = self.accessor.lookup(vars, None)  # Assume missing template variable is False.
         if self.inverting:
             ok = not ok
         if not ok:
-            if verbose:
-                print("%sCond.render cond is False, empty string returned" % indent(level))
-            return ""
-        output = ""
-        for child in self:
-            if verbose:
-                print("%sCond.render child %s" % (indent(level), child))
-            value = child.render(vars, last, level + 1)
-            if value:
-                output += value
-        return output
+            return
+        yield from self.iter_children(vars, last, tracer)
+
+    async def aiter_render(self, vars, last=False):
+        ok = await self.accessor.alookup(vars, None)
+        if self.inverting:
+            ok = not ok
+        if not ok:
+            return
+        async for chunk in super(Cond, self).aiter_render(vars, last):
+            yield chunk
+
+    def gencode(self, gen):
+        gen.lookup(self.accessor, "_x", "None")
+        gen.emit("if %s_x:" % ("not " if self.inverting else ""))
+        strict, gen.strict = gen.strict, False  # The validator doesn't check the variables that are guarded by Conds.
+        with gen.block():
+            super(Cond, self).gencode(gen)
+        gen.strict = strict
 
 
 class Rep(Container):
     "Container for repeating content."
+    __slots__ = ("accessor", "_nameaccessors")
 
     def __init__(self, name):
         super(Rep, self).__init__(name)
+        self.accessor = Accessor(name)
+        self._nameaccessors = None
 
     def __repr__(self):
         return super(Rep, self).__repr__()
 
+    def ownnames(self):
+        return (self.accessor.head,)
 
-    def render(self, vars, last, level):
-        if verbose:
-            print("%sRep.render(vars=%s) type(vars)=%s, self.name=%s" % (indent(level),vars,type(vars),self.name))
-        output = ""
-        #if not self.name in vars:
-        #    raise NameNotFound("A required variable name '%s' was not present in '%r'" % (self.name, vars))
+    def iter_render(self, vars, last=False, tracer=None):
         # TODO: This can provide useful debugging info: if not self.name in vars: raise NameNotFound("A required variable name '%s' was not present in '%r'" % (self.name, vars))
+        subvars = self.accessor.lookup(vars)
+        if subvars is _MISSING:
+            yield _errorspan("Rep", self.name)
+            return
+        parent = vars if vars.__class__ is Scope else Scope(vars)
+        loop = Loop()
+        pairs = subvars.pairs(self.textnames()) if subvars.__class__ is Columns else _lookahead(subvars)
+        for nr, (subvar, last) in enumerate(pairs):
+            loop.index0 = nr
+            loop.last = last
+            yield from self.iter_children(Scope(subvar, parent, loop), last, tracer)
+
+    async def aiter_render(self, vars, last=False):
+        subvars = await self.accessor.alookup(vars)
+        if subvars is _MISSING:
+            yield _errorspan("Rep", self.name)
+            return
+        loop = Loop()
+        nr = 0
+        async for subvar, last in _alookahead(subvars):
+            loop.index0 = nr
+            loop.last = last
+            nr += 1
+            scope = _asyncscope(subvar, self.nameaccessors(), vars, loop)
+            try:
+                async for chunk in super(Rep, self).aiter_render(scope, last):
+                    yield chunk
+            finally:
+                scope.cancel()
+
+    def nameaccessors(self):
+        """The Accessors of allnames(), made on first use: the body of the Rep is done by then. Every item of an async
+        render uses them, and the Accessors learn the getters for the types of the items."""
+        if self._nameaccessors is None:
+            self._nameaccessors = tuple(Accessor(name) for name in sorted(self.allnames()))
+        return self._nameaccessors
+
+    def usesloop(self):
+        """Whether the body refers to the loop variable, so the generated code has to keep a Loop up to date."""
+        return "loop" in self.scopenames()
+
+    def textnames(self):
+        """The names that the body only substitutes as they are, like {=price} and not {=price.amount} or {?price ...},
+        which a Columns source can convert to text in advance."""
+        subs = set()
+        others = set()
+        stack = list(self)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Sub) and len(node.accessor.steps) == 1:
+                subs.add(node.accessor.head)
+            elif not isinstance(node, Lit):
+                others.update(node.ownnames())
+                stack.extend(node)
+        return tuple(sorted(subs - others))
+
+    def gencode(self, gen):
+        depth = gen.depth + 1
+        strict = gen.strict and not (self.accessor.head == "loop" and gen.depth > 0)
+        gen.lookup(self.accessor, "_s%d" % depth, None if strict else "_MISSING")
+        if not strict:
+            gen.emit("if _s%d is _MISSING:" % depth)
+            gen.emit("    yield %r" % _errorspan("Rep", self.name))
+            gen.emit("else:")
+        with gen.block() if not strict else contextlib.nullcontext():
+            gen.emit("_s%d = _s%d.pairs(%r) if _s%d.__class__ is Columns else _lookahead(_s%d)" % (depth, depth, self.textnames(), depth, depth))
+            if self.usesloop():
+                gen.emit("loop%d = Loop()" % depth)
+                gen.emit("for _i%d, (v%d, last%d) in enumerate(_s%d):" % (depth, depth, depth, depth))
+            else:
+                gen.emit("for v%d, last%d in _s%d:" % (depth, depth, depth))
+            with gen.block(depth):
+                if self.usesloop():
+                    gen.emit("loop%d.index0 = _i%d" % (depth, depth))
+                    gen.emit("loop%d.last = last%d" % (depth, depth))
+                super(Rep, self).gencode(gen)
+
+
+class FragmentCache(object):
+    """Interface of the cache for the output of {%...} blocks. The keys are tuples of the fragment's identity and
+    the values of its key variables; a cache in an external store would have to serialize them. Implement get() and
+    set(), and pass an instance to the Environment of the templates."""
+
+    def get(self, key):
+        """Return the cached text for 'key', or None."""
+        return None
+
+    def set(self, key, text, ttl=None):
+        """Cache 'text' under 'key', for at most 'ttl' seconds when that isn't None."""
+
+    def stats(self):
+        return {}
+
+    def clear(self):
+        pass
+
+
+class LRUFragmentCache(FragmentCache):
+    """The default FragmentCache: keeps the 'maxsize' most recently used fragments in memory.
+    It can be shared by many threads."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()  # key -> (text, expiry time or None)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                del self.cache[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, text, ttl=None):
+        expiry = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.cache[key] = (text, expiry)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Return the cache counters."""
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, expirations=self.expirations, size=len(self.cache))
+
+    def clear(self):
+        """Empty the cache."""
+        with self.lock:
+            self.cache.clear()
+
+    def __reduce__(self):
+        # A pickled cache, e.g. in a template sent to a worker process, arrives empty.
+        return LRUFragmentCache, (self.maxsize,)
+
+
+def _cachedfragment(cache, key, ttl, render):
+    """Return the output of a {%...} block from 'cache', or produce it by joining render() and cache it.
+    Fragments with key values that can't be hashed aren't cached."""
+    try:
+        text = cache.get(key)
+    except TypeError:
+        return "".join(render())
+    if text is None:
+        text = "".join(render())
+        cache.set(key, text, ttl)
+    return text
+
+
+class Fragment(Container):
+    """Container for a cached fragment: {%key=a,b ttl=60 ...} renders its content once for every combination of the
+    values of the variables a and b, and takes the output from the fragment cache after that, for at most 60 seconds.
+    Everything the content depends on should be among the key variables. The template binds the fragment to the
+    fragment cache of its Environment."""
+    __slots__ = ("keys", "ttl", "_ident", "cache")
+
+    def __init__(self, name):
+        super(Fragment, self).__init__(name)
+        names = name[4:] if name.startswith("key=") else name
+        self.keys = tuple(Accessor(key) for key in names.split(",") if key)
+        self.ttl = None
+        self._ident = None
+        self.cache = defaultenvironment.fragmentcache
+
+    def __repr__(self):
+        return super(Fragment, self).__repr__()
+
+    def __getstate__(self):
+        # The cache isn't pickled (nor copied), the template that gets the fragment binds it again.
+        return None, dict((slot, getattr(self, slot)) for slot in ("name", "line", "col", "keys", "ttl", "_ident"))
+
+    def __setstate__(self, state):
+        for slot, value in state[1].items():
+            setattr(self, slot, value)
+        self.cache = defaultenvironment.fragmentcache
+
+    def ownnames(self):
+        return tuple(accessor.head for accessor in self.keys)
+
+    def takeoptions(self, rest):
+        """Take the options (only ttl=<seconds>) from the start of the text after the name, and return the text after them.
+        Raises ValueError for a bad option value."""
+        while rest.startswith("ttl="):
+            parts = whitechars.split(rest, 1)
+            try:
+                self.ttl = float(parts[0][4:])
+            except ValueError:
+                raise ValueError("Bad fragment option %r" % parts[0]) from None
+            rest = parts[1] if len(parts) > 1 else ""
+        return rest
+
+    @property
+    def ident(self):
+        """Identifies the fragment in the cache keys: a hash of its content, so identical fragments share their cache entries.
+        The repr of the nodes has everything that makes a difference to the output, like Cond.inverting and Sub.escape."""
+        if self._ident is None:
+            self._ident = hashlib.sha256(repr(self).encode("utf8")).hexdigest()[:32]
+        return self._ident
+
+    def key(self, vars, last):
+        return (self.ident, last) + tuple(accessor.lookup(vars, None) for accessor in self.keys)
+
+    def iter_render(self, vars, last=False, tracer=None):
+        text = _cachedfragment(self.cache, self.key(vars, last), self.ttl, lambda: self.iter_children(vars, last, tracer))
+        if text:
+            yield text
+
+    async def aiter_render(self, vars, last=False):
+        key = (self.ident, last) + tuple([await accessor.alookup(vars, None) for accessor in self.keys])
         try:
-            subvars = vars[self.name]  # A KeyError here means that a required variable wasn't present.
+            text = self.cache.get(key)
         except TypeError:
-            subvars = getattr(vars, self.name)
-        except KeyError:
-            return '<span class="paulatemplate_error" style="background-color: red; color: white;">Template error in Rep: unknown variable "%s"</span>' % self.name
-        for nr, subvar in enumerate(subvars):
-            if verbose:
-                print("%sRep.render subvar=%s, type(subvar)=%s" % (indent(level),subvar,type(subvar)))
-            for child in self:
-                last = nr == len(subvars)-1
-                if verbose:
-                    print("%sRep.render child %s, last=%s" % (indent(level), child,last))
-                output += child.render(subvar, last, level+1)
-        return output
+            key = text = None
+        if text is None:
+            text = "".join([chunk async for chunk in super(Fragment, self).aiter_render(vars, last)])
+            if key is not None:
+                self.cache.set(key, text, self.ttl)
+        if text:
+            yield text
+
+    def gencode(self, gen):
+        gen.emit("_k = (%r, last%d)" % (self.ident, gen.depth))
+        for accessor in self.keys:
+            gen.lookup(accessor, "_x", "None")
+            gen.emit("_k += (_x,)")
+        # The content becomes a nested generator function, which sees the variables of the enclosing scopes.
+        func = "_f%d" % len(gen.lines)
+        gen.emit("def %s():" % func)
+        with gen.block():
+            super(Fragment, self).gencode(gen)
+            gen.emit("return")
+            gen.emit("yield")
+        gen.emit("_x = _cachedfragment(_fragmentcache, _k, %r, %s)" % (self.ttl, func))
+        gen.emit("if _x:")
+        gen.emit("    yield _x")
+
+
+class Include(Container):
+    """Container for an include of another template: {>partials/row}. A TemplateLoader links the template, replacing
+    the Include by the content of the included template. An Include that isn't linked renders as an error."""
+    __slots__ = ()
+
+    def __repr__(self):
+        return super(Include, self).__repr__()
+
+    def error(self):
+        return '<span class="paulatemplate_error" style="background-color: red; color: white;">Template error in Include: template "%s" is not linked</span>' % self.name
+
+    def iter_render(self, vars, last=False, tracer=None):
+        yield self.error()
+
+    async def aiter_render(self, vars, last=False):
+        yield self.error()
+
+    def gencode(self, gen):
+        gen.emit("yield %r" % self.error())
 
 
 def splitfirst(s):
@@ -206,41 +966,50 @@ def feed(seq):
         yield item
 
 
-def lexer(it):
+tokenre = re.compile("[{}]|[^{}]+")
+
+
+def lexer(source):
     """Split input into tokens. A token is either an open curly brace, a closing curly brace, or a string without curly braces."""
-    tokens = []
-    token = ""
-    for c in it:
-        if c == "{":
-            if token:
-                tokens.append(token)
-                token = ""
-            tokens.append(c)
-        elif c == "}":
-            if token:
-                tokens.append(token)
-                token = ""
-            tokens.append(c)
-        else:
-            token += c
-    if token:
-        tokens.append(token)
-    return tokens
+    if not isinstance(source, str):
+        source = "".join(source)
+    return tokenre.findall(source)
+
+
+class Group(list):
+    "A {...} group from the parser, with the line and column (both 1-based) of its opening brace."
+    __slots__ = ("line", "col")
 
 
-def parse(it, node, nesting=0):
-    """Build a (recursive) nested list from the tokens."""
-    for token in it:
+def parse(tokens, node=None):
+    """Build a nested list from the tokens, with a Group for every {...}.
+    Uses an explicit stack instead of recursion, so the nesting depth is unlimited."""
+    if node is None:
+        node = []
+    stack = []
+    line = 1
+    linestart = offset = 0  # Offsets in the source of the current line, and of the current token.
+    for token in tokens:
         if token == "{":
-            subnode = []
-            node.append(subnode)
-            parse(it, subnode, nesting + 1)
+            group = Group()
+            group.line = line
+            group.col = offset - linestart + 1
+            node.append(group)
+            stack.append(node)
+            node = group
+            offset += 1
         elif token == "}":
-            if nesting == 0:
-                raise Exception("Unbalanced }")
-            return
+            if not stack:
+                raise Exception("Unbalanced } at line %d, column %d" % (line, offset - linestart + 1))
+            node = stack.pop()
+            offset += 1
         else:
             node.append(token)
+            if "\n" in token:
+                line += token.count("\n")
+                linestart = offset + token.rindex("\n") + 1
+            offset += len(token)
+    return stack[0] if stack else node
 
 
 createinfo = {
@@ -248,97 +1017,1467 @@ createinfo = {
     "!": (functools.partial(Cond, inverting=True), CHOPNAME),
     "#": (Rep, CHOPNAME),
     "=": (Sub, CHOPITEM),
+    "~": (Sub, CHOPITEM),
     "/": (Sep, CHOPNAME),
+    "%": (Fragment, CHOPOPTIONS),
+    ">": (Include, CHOPITEM),
     }
 
 
-def compile(node, into, level=0):
-    if verbose:
-        print("%s compile: " % indent(level), node)
-    for pos, item in enumerate(node):
-        if isinstance(item, list):
-            if verbose:
-                print("%s #%d list: %r" % (indent(level), pos, item))
-            head = item[0]
-            if not head[0] in createinfo:
-                if exceptionless:
-                    return Lit("<span style=\"background-color: red; color: white;\">Template error: '{' without a following valid metachar</span>")
-                else:
+def compile(node, into, env=None):
+    """Turn the nested lists from parse() into a tree of containers, appended to 'into', with the settings of the
+    Environment 'env' (the default environment when None). Uses an explicit stack instead of recursion, so the
+    nesting depth is unlimited."""
+    env = env or defaultenvironment
+    exceptionless, autoescape = env.exceptionless, env.autoescape
+    result = into
+    stack = [(iter(node), into)]
+    while stack:
+        items, into = stack[-1]
+        for item in items:
+            if not isinstance(item, list):
+                into.append(Lit(item))
+                continue
+            head = item[0] if item else ""
+            if not head or not head[0] in createinfo:
+                if not exceptionless:
                     raise ValueError("'{' without a following valid metachar")
+                # The whole container that holds the bad '{' is replaced by the error message.
+                error = Lit("<span style=\"background-color: red; color: white;\">Template error: '{' without a following valid metachar</span>")
+                stack.pop()
+                if stack:
+                    stack[-1][1][-1] = error
+                else:
+                    result = error
+                break
             first, rest = splitfirst(head)
             operator, name = first[0], first[1:]
-            if verbose:
-                print("%s operator %s, name %s, rest %r" % (indent(level), operator, name, rest))
             # Create correct container
             factoryfunc, options = createinfo[operator]
             ob = factoryfunc(name)
+            ob.line = getattr(item, "line", None)
+            ob.col = getattr(item, "col", None)
+            if autoescape and operator == "=":
+                ob.escape = True
             if options == CHOPNAME:
                 item[0] = rest
+            elif options == CHOPOPTIONS:
+                try:
+                    item[0] = ob.takeoptions(rest)
+                except ValueError as e:
+                    message = "%s at line %s, column %s" % (e, ob.line, ob.col)
+                    if not exceptionless:
+                        raise ValueError(message) from None
+                    # The container with the bad option is replaced by the error message.
+                    into.append(Lit("<span style=\"background-color: red; color: white;\">Template error: %s</span>" % html.escape(message)))
+                    continue
             elif options == CHOPITEM:
                 item = item[1:]
-            into.append(compile(item, ob, level + 1))
+            into.append(ob)
+            stack.append((iter(item), ob))
+            break
+        else:
+            stack.pop()
+    return result
+
+
+class _Recorder(dict):
+    """The constants while optimize() tries to render a Rep in advance. Remembers the names that were looked up but aren't there."""
+
+    def __init__(self, constants):
+        super(_Recorder, self).__init__(constants)
+        self.missed = set()
+
+    def __missing__(self, key):
+        self.missed.add(key)
+        raise KeyError(key)
+
+
+def _shallowcopy(node):
+    """A copy of the node without its children."""
+    result = copy.copy(node)
+    del result[:]
+    if isinstance(result, Fragment):
+        result._ident = None  # The identity of a Fragment depends on its children.
+    elif isinstance(result, Rep):
+        result._nameaccessors = None  # So do the names of a Rep.
+    return result
+
+
+def _coalesce(nodes):
+    """Merge every run of adjacent Lits into a single Lit, leaving out the empty ones."""
+    result = []
+    run = []
+    for node in itertools.chain(nodes, [None]):
+        if isinstance(node, Lit):
+            if node[0]:
+                run.append(node)
+            continue
+        if len(run) == 1:
+            result.append(run[0])
+        elif run:
+            result.append(Lit("".join(lit[0] for lit in run)))
+        run = []
+        if node is not None:
+            result.append(node)
+    return result
+
+
+def optimize(root, constants=None, resolve=None):
+    """Return an optimized copy of the compiled template tree 'root'. Adjacent literals are merged, and empty literals,
+    conditions and separators are left out. 'constants' are template variables that are known in advance. Outside of
+    Reps, substitutions of a constant become literals, conditions on a constant are decided, and a Rep over a constant
+    is rendered right away when its body needs no other variables. Inside Reps the constants are left alone, because
+    the items can have variables with the same names. 'resolve' links the template: every Include is replaced by the
+    content of resolve(name), the compiled tree of the included template. Uses an explicit stack, like compile()."""
+    if isinstance(root, Lit):
+        return root
+    constants = constants or {}
+    result = _shallowcopy(root)
+    # Each entry: the children still to do, the clone of their container (None when they go straight
+    # into the output of the enclosing container), the output so far, and whether this is outside of Reps.
+    stack = [(iter(root), result, [], True)]
+    while stack:
+        children, clone, output, static = stack[-1]
+        for child in children:
+            if isinstance(child, Lit):
+                output.append(child)
+            elif isinstance(child, Include) and resolve is not None:
+                included = resolve(child.name)
+                stack.append((iter([included] if isinstance(included, Lit) else included), None, output, static))
+                break
+            elif static and isinstance(child, (Sub, Cond, Rep)) and child.accessor.head in constants:
+                if isinstance(child, Sub):
+                    output.append(Lit("".join(child.iter_render(constants))))
+                elif isinstance(child, Cond):
+                    if bool(child.accessor.lookup(constants, None)) != child.inverting:
+                        stack.append((iter(child), None, output, True))
+                        break
+                else:
+                    if isinstance(child.accessor.lookup(constants), collections.abc.Collection):
+                        recorder = _Recorder(constants)
+                        text = child.render(recorder)
+                        if not recorder.missed:
+                            output.append(Lit(text))
+                            continue
+                    stack.append((iter(child), _shallowcopy(child), [], False))
+                    break
+            elif isinstance(child, Sub):
+                output.append(child)
+            else:
+                stack.append((iter(child), _shallowcopy(child), [], static and not isinstance(child, Rep)))
+                break
         else:
-            if verbose:
-                print("%s #%d item: %s" % (indent(level), pos, item))
-            into.append(Lit(item))
-    return into
-
-
-def process(sourcetext):
-    if verbose:
-        print("\n\n\nCompile phase")
-    tokens = lexer(feed(sourcetext))
-    # root = Container()
-    root = []
-    parse(feed(tokens), root)
-    result = compile(root, Container())
-    if verbose:
-        print("Compile result:", result)
+            stack.pop()
+            if clone is not None:
+                clone[:] = _coalesce(output)
+                if stack and (clone or not isinstance(clone, (Cond, Sep))):
+                    stack[-1][2].append(clone)
     return result
 
 
+_linebreak = re.compile(r"[ \t]*\n\s*")
+_whitespace = re.compile(r"\s+")
+_preserved = re.compile(r"<(/?)(pre|textarea|script|style)\b[^>]*>", re.IGNORECASE)
+
+
+def trimwhitespace(root, mode):
+    """Trim the whitespace in the literals of a compiled template tree, in place. Modes:
+
+        "lines"     strip the indentation and the trailing whitespace of every line, and leave out empty lines
+        "collapse"  replace every run of whitespace by a single space
+        "html"      like "collapse", except in the content of <pre>, <textarea>, <script> and <style> elements
+
+    The literals are scanned in template order, so a line or an element can start and end in different literals
+    (whatever the conditions and repetitions between them do). A run of whitespace that a variable, condition or
+    repetition interrupts is collapsed on both sides, so no space between words can get lost. Only the template
+    text is trimmed, never the values that are substituted into it."""
+    if mode not in ("lines", "collapse", "html"):
+        raise ValueError("Unknown whitespace mode %r" % mode)
+    trim = functools.partial(_whitespace.sub, " ")
+    linestart = True  # Whether the template text so far ends a line.
+    preserving = None  # The element whose content is kept as it is.
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (Sub, Include)):
+            linestart = False
+        elif not isinstance(node, Lit):
+            stack.extend(reversed(node))
+        elif mode == "lines":
+            text = _linebreak.sub("\n", node[0].lstrip() if linestart else node[0])
+            linestart = text.endswith("\n") if text else linestart
+            node[0] = text
+        elif mode == "collapse":
+            node[0] = trim(node[0])
+        else:
+            text = node[0]
+            pieces = []
+            pos = 0
+            for match in _preserved.finditer(text):
+                pieces.append(text[pos:match.start()] if preserving else trim(text[pos:match.start()]))
+                pieces.append(match.group())
+                pos = match.end()
+                closing, tag = match.group(1), match.group(2).lower()
+                if preserving is None and not closing:
+                    preserving = tag
+                elif closing and tag == preserving:
+                    preserving = None
+            pieces.append(text[pos:] if preserving else trim(text[pos:]))
+            node[0] = "".join(pieces)
+    return root
+
+
+def process(sourcetext, env=None):
+    env = env or defaultenvironment
+    root = compile(parse(lexer(sourcetext)), Container(), env)
+    if env.whitespace:
+        trimwhitespace(root, env.whitespace)
+    return optimize(root)
+
+
+class CodeGen(object):
+    """Collects the Python source lines that the nodes of a template emit with their gencode() methods.
+    'depth' is the Rep nesting level; the variables in scope at depth d are v<d>, and last<d> tells whether
+    the current iteration of the enclosing Rep is the last one."""
+
+    def __init__(self, strict=False):
+        self.strict = strict  # For render_strict(): the variables were validated, so they aren't missing.
+        self.prelude = []  # Module-level statements that set up the constants the render function uses.
+        self.constants = {}
+        self.lines = []
+        self.level = 1
+        self.depth = 0
+
+    def emit(self, line):
+        self.lines.append("    " * self.level + line)
+
+    def constant(self, expr):
+        """Return the name of a module-level constant with the value of the Python expression 'expr'."""
+        if expr not in self.constants:
+            self.constants[expr] = "_c%d" % len(self.constants)
+            self.prelude.append("%s = %s" % (self.constants[expr], expr))
+        return self.constants[expr]
+
+    @contextlib.contextmanager
+    def block(self, depth=None):
+        """Indent the lines emitted inside the with-block, optionally entering a deeper Rep scope."""
+        prevdepth = self.depth
+        nlines = len(self.lines)
+        self.level += 1
+        if depth is not None:
+            self.depth = depth
+        yield
+        if len(self.lines) == nlines:
+            self.emit("pass")
+        self.level -= 1
+        self.depth = prevdepth
+
+    def lookup(self, accessor, var, missing):
+        """Emit the lookup of the Accessor 'accessor' into the Python variable 'var'.
+        'missing' is the Python expression for the value when the template variable isn't there, or None for a
+        variable that was validated (see CodeGen.strict): then a missing variable raises an exception.
+        A name in the body of a Rep is looked up in the current item first, and then in the enclosing scopes.
+        'loop' in the body of a Rep is the Loop of that Rep, unless the current item has a 'loop' of its own."""
+        v = "v%d" % self.depth
+        if accessor.head == "loop" and self.depth > 0:
+            a = self.constant("Accessor(%r)" % accessor.path)
+            self.emit("%s = %s.get('loop', _MISSING) if %s.__class__ is dict else %s.probe(%s)" % (var, v, v, a, v))
+            self.emit("if %s is _MISSING:" % var)
+            self.emit("    %s = loop%d" % (var, self.depth))
+            if len(accessor.steps) > 1:
+                self.emit("%s = %s.follow(%s)" % (var, a, var))
+                self.emit("if %s is _MISSING:" % var)
+                self.emit("    %s = %s" % (var, missing))
+        elif self.depth == 0:
+            if len(accessor.steps) == 1:
+                # The getter for the type of the value is fetched right here, saving a call.
+                step = self.constant("Accessor(%r).steps[0]" % accessor.path)
+                getters = self.constant("%s.getters.get" % step)
+                expr = "%s(%s.__class__, %s)(%s)" % (getters, v, step, v)
+            else:
+                expr = "%s(%s)" % (self.constant("Accessor(%r)" % accessor.path), v)
+            if missing is None:
+                self.emit("%s = %s" % (var, expr))
+            else:
+                self.emit("try:")
+                self.emit("    %s = %s" % (var, expr))
+                self.emit("except _LOOKUPERRORS:")
+                self.emit("    %s = %s" % (var, missing))
+        else:
+            a = self.constant("Accessor(%r)" % accessor.path)
+            self.emit("%s = %s.get(%r, _MISSING) if %s.__class__ is dict else %s.probe(%s)" % (var, v, accessor.head, v, a, v))
+            self.emit("if %s is _MISSING:" % var)
+            self.emit("    %s = %s.find((%s,))" % (var, a, ", ".join("v%d" % depth for depth in range(self.depth - 1, -1, -1))))
+            if missing is None:
+                # The items of iterators aren't validated, so this can still happen.
+                self.emit("    if %s is _MISSING:" % var)
+                self.emit("        raise ValueError(%r)" % ("Missing template variable: %s" % accessor.path))
+                if len(accessor.steps) > 1:
+                    self.emit("%s = %s(%s)" % (var, self.constant("Accessor(%r)" % accessor.path.split(".", 1)[1]), var))
+            else:
+                if len(accessor.steps) > 1:
+                    self.emit("if %s is not _MISSING:" % var)
+                    self.emit("    %s = %s.follow(%s)" % (var, a, var))
+                self.emit("if %s is _MISSING:" % var)
+                self.emit("    %s = %s" % (var, missing))
+
+
+def codegen(root, repbody=False, strict=False):
+    """Generate the Python source of a render function for a compiled template tree.
+    The function is a generator that yields the output in chunks.
+    With 'repbody', 'root' is the body of a top-level Rep, and the function renders it for one item:
+    render(item, last, vars, loop), with 'vars' the variables of the enclosing scope and 'loop' a Loop.
+    With 'strict', it's the render function for variables that passed the validator, see CodeGen.lookup()."""
+    gen = CodeGen(strict)
+    if repbody:
+        gen.depth = 1
+    root.gencode(gen)
+    gen.emit("return")
+    gen.emit("yield  # Makes this a generator function, even for a template without output.")
+    signature = "def render(v1, last1, v0, loop1):" if repbody else "def render(v0, last0=False):"
+    return "\n".join(gen.prelude + [signature] + gen.lines) + "\n"
+
+
+def gencompile(root, name=None, repbody=False, strict=False):
+    """Generate and compile the Python code of the render function for a compiled template tree.
+    Returns None when the tree can't be expressed as Python source (e.g. Python's nesting limits are exceeded),
+    in which case the caller should fall back to the tree interpreter."""
+    try:
+        return builtins.compile(codegen(root, repbody, strict), "<paulatemplate %s>" % (name or "string"), "exec")
+    except (SyntaxError, RecursionError):
+        return None
+
+
+def _requiredpaths(schema, prefix=""):
+    """Yield (path, Variable) for every substituted or iterated variable in 'schema' that rendering needs."""
+    for name, variable in sorted(schema.items()):
+        if variable.guarded:
+            continue
+        if variable.kind in ("scalar", "iterated"):
+            yield prefix + name, variable
+        yield from _requiredpaths(variable.children, prefix + name + ".")
+
+
+def genvalidator(schema, name=None):
+    """Generate and compile a validator for the schema from variables(): validate(vars) checks the variables in one
+    pass and returns a list of the required variables that are missing, like "rows[3].title". The items of sequences
+    are checked one by one; iterators aren't checked (that would use them up), and Columns only by their names.
+    Every Rep becomes a function of its own that checks all of its items, the names of a dict item at once."""
+    gen = CodeGen()
+    scopes = [(schema, "")]  # The schema of every scope, and the format of the paths of the variables in it.
+    for nr, (schema, prefix) in enumerate(scopes):
+        def message(path):
+            return "%r %% (indexes + (_i,))" % (prefix + path.replace("%", "%%")) if nr else repr(path)
+
+        def check(path, variable):
+            a = gen.constant("Accessor(%r)" % path)
+            if nr == 0:
+                gen.emit("_x = %s.lookup(v)" % a)
+            else:
+                gen.emit("_x = v.get(%r, _MISSING) if v.__class__ is dict else %s.probe(v)" % (path.split(".", 1)[0], a))
+                gen.emit("if _x is _MISSING:")
+                gen.emit("    _x = %s.find(scopes)" % a)
+                if "." in path:
+                    gen.emit("if _x is not _MISSING:")
+                    gen.emit("    _x = %s.follow(_x)" % a)
+            gen.emit("if _x is _MISSING:")
+            gen.emit("    errors.append(%s)" % message(path))
+            items = [item for item in sorted(variable.items) if variable.items[item].required]
+            if variable.kind != "iterated" or not items:
+                return
+            outer = "(v,) + scopes" if nr else "(v,)"  # The scopes around the items, innermost first.
+            gen.emit("elif _x.__class__ is Columns:")
+            with gen.block():
+                for item in items:
+                    gen.emit("if %r not in _x.columns and %s.find(%s) is _MISSING:" % (item, gen.constant("Accessor(%r)" % item), outer))
+                    gen.emit("    errors.append(%s)" % message("%s.%s" % (path, item)))
+            gen.emit("elif isinstance(_x, _Collection):")
+            gen.emit("    _scope%d(errors, _x, %s, %s)" % (len(scopes), outer, "indexes + (_i,)" if nr else "()"))
+            scopes.append((variable.items, prefix + path.replace("%", "%%") + "[%d]."))
+
+        paths = list(_requiredpaths(schema))
+        if nr == 0:
+            gen.lines.append("def _scope0(errors, v):")
+            simple = []
+        else:
+            gen.lines.append("def _scope%d(errors, items, scopes, indexes):" % nr)
+            gen.emit("for _i, v in enumerate(items):")
+            gen.level += 1
+            simple = [(path, variable) for path, variable in paths if variable.kind == "scalar" and "." not in path]
+        if simple:
+            names = gen.constant("frozenset(%r)" % [path for path, variable in simple])
+            gen.emit("if v.__class__ is not dict or not v.keys() >= %s:" % names)
+            with gen.block():
+                for path, variable in simple:
+                    check(path, variable)
+        for path, variable in paths:
+            if (path, variable) not in simple:
+                check(path, variable)
+        gen.emit("pass")
+        gen.level = 1
+    source = "\n".join(gen.prelude + gen.lines) + "\n"
+    source += "def validate(vars):\n    errors = []\n    _scope0(errors, vars)\n    return errors\n"
+    namespace = {"Accessor": Accessor, "Columns": Columns, "_MISSING": _MISSING, "_Collection": collections.abc.Collection}
+    exec(builtins.compile(source, "<paulatemplate validator %s>" % (name or "string"), "exec"), namespace)
+    return namespace["validate"]
+
+
+def makefunction(code, env=None):
+    """Exec the code from gencompile() and return the render function it defines, bound to the Environment 'env'."""
+    namespace = {"Accessor": Accessor, "Loop": Loop, "_LOOKUPERRORS": _LOOKUPERRORS, "_text": _text, "_lookahead": _lookahead, "_MISSING": _MISSING,
+                 "Columns": Columns, "_cachedfragment": _cachedfragment, "_fragmentcache": (env or defaultenvironment).fragmentcache, "Markup": Markup, "_escaped": _escaped, "_htmlescape": html.escape}
+    exec(code, namespace)
+    return namespace["render"]
+
+
+OP_LIT, OP_SUB, OP_IF, OP_IFNOT, OP_SEP, OP_REP, OP_NEXT, OP_NODE, OP_ESCAPE = range(9)
+
+
+class Tape(object):
+    """A compiled template as a flat instruction tape, for the "tape" backend. It takes much less memory than the
+    tree of nodes it's made from. 'code' is an array of integers, in which every instruction is an opcode followed
+    by its operands: indexes into the tables of literals, accessors (one for every distinct variable name, interned)
+    and nodes, or jump targets.
+
+        LIT literal             output the literal
+        SUB accessor            output the variable
+        ESCAPE accessor         output the variable, HTML-escaped unless it's markup
+        IF accessor target      jump to target unless the variable is true
+        IFNOT accessor target   jump to target if the variable is true
+        SEP target              jump to target in the last iteration of the enclosing Rep
+        REP accessor names target
+                                start iterating over the variable, jump to target if there are no items; names is
+                                an index into the table of Rep.textnames(), for a Columns source
+        NEXT target             jump back to target, the start of the Rep body, for the next item
+        NODE node               render a node (a Fragment) with the tree interpreter
+
+    'positions' has the source positions of the nodes, for tree(): the start of an instruction in the code, and
+    the line and column of the node it was made from, for every node with a position.
+    """
+    __slots__ = ("code", "literals", "accessors", "names", "nodes", "positions")
+
+    def __init__(self, root):
+        code = array.array("i")
+        literals = {}
+        accessors = {}
+        names = {}
+        nodes = []
+        positions = array.array("i")
+
+        def accessor(node):
+            return accessors.setdefault(sys.intern(node.accessor.path), len(accessors))
+
+        def position(node):
+            # Only for the nodes that tree() makes anew; the others keep their positions.
+            if node.line is not None:
+                positions.extend((len(code), node.line, node.col))
+
+        # Each entry: the children still to do, and the node they're in with the position of its body in the code,
+        # or None when the end of the node needs no instructions.
+        stack = [(iter([root] if isinstance(root, Lit) else root), None)]
+        while stack:
+            children, entry = stack[-1]
+            for child in children:
+                if isinstance(child, Lit):
+                    if child[0]:
+                        position(child)
+                        code.extend((OP_LIT, literals.setdefault(child[0], len(literals))))
+                elif isinstance(child, Sub):
+                    position(child)
+                    code.extend((OP_ESCAPE if child.escape else OP_SUB, accessor(child)))
+                elif isinstance(child, (Cond, Sep, Rep)):
+                    position(child)
+                    if isinstance(child, Cond):
+                        code.extend((OP_IFNOT if child.inverting else OP_IF, accessor(child), 0))
+                    elif isinstance(child, Sep):
+                        code.extend((OP_SEP, 0))
+                    else:
+                        code.extend((OP_REP, accessor(child), names.setdefault(child.textnames(), len(names)), 0))
+                    stack.append((iter(child), (child, len(code))))
+                    break
+                elif child.__class__ is Container:
+                    stack.append((iter(child), None))
+                    break
+                else:
+                    code.extend((OP_NODE, len(nodes)))
+                    nodes.append(child)
+            else:
+                stack.pop()
+                if entry is not None:
+                    node, start = entry
+                    if isinstance(node, Rep):
+                        code.extend((OP_NEXT, start))
+                    code[start - 1] = len(code)
+        self.code = code
+        self.literals = tuple(literals)
+        self.accessors = tuple(Accessor(path) for path in accessors)
+        self.names = tuple(names)
+        self.nodes = tuple(nodes)
+        self.positions = positions
+
+    def run(self, vars, last=False):
+        """Yield the output for the variables 'vars' in chunks, like Container.iter_render()."""
+        code = self.code
+        literals = self.literals
+        accessors = self.accessors
+        scope = vars
+        frames = []  # For every Rep being iterated: (items, loop, scope of the items, scope and 'last' outside the Rep)
+        pc = 0
+        end = len(code)
+        while pc < end:
+            op = code[pc]
+            if op == OP_LIT:
+                yield literals[code[pc + 1]]
+                pc += 2
+            elif op == OP_SUB:
+                value = accessors[code[pc + 1]].lookup(scope)
+                if value.__class__ is not str:
+                    value = _text(value) if value is not _MISSING else _errorspan("Sub", accessors[code[pc + 1]].path)
+                if value:
+                    yield value
+                pc += 2
+            elif op == OP_ESCAPE:
+                value = accessors[code[pc + 1]].lookup(scope)
+                if value is _MISSING:
+                    value = _errorspan("Sub", accessors[code[pc + 1]].path)
+                else:
+                    value = html.escape(value) if value.__class__ is str else _escaped(value)
+                if value:
+                    yield value
+                pc += 2
+            elif op == OP_IF or op == OP_IFNOT:
+                ok = accessors[code[pc + 1]].lookup(scope, None)  # Assume missing template variable is False.
+                pc = pc + 3 if (not ok) == (op == OP_IFNOT) else code[pc + 2]
+            elif op == OP_SEP:
+                pc = code[pc + 1] if last else pc + 2
+            elif op == OP_REP:
+                items = accessors[code[pc + 1]].lookup(scope)
+                if items is _MISSING:
+                    yield _errorspan("Rep", accessors[code[pc + 1]].path)
+                    pc = code[pc + 3]
+                    continue
+                items = items.pairs(self.names[code[pc + 2]]) if items.__class__ is Columns else _lookahead(items)
+                for item, itemlast in items:
+                    loop = Loop()
+                    loop.last = itemlast
+                    parent = scope if scope.__class__ is Scope else Scope(scope)
+                    frames.append((items, loop, parent, scope, last))
+                    scope = Scope(item, parent, loop)
+                    last = itemlast
+                    pc += 4
+                    break
+                else:
+                    pc = code[pc + 3]
+            elif op == OP_NEXT:
+                items, loop, parent, outer, outerlast = frames[-1]
+                for item, last in items:
+                    loop.index0 += 1
+                    loop.last = last
+                    scope = Scope(item, parent, loop)
+                    pc = code[pc + 1]
+                    break
+                else:
+                    frames.pop()
+                    scope = outer
+                    last = outerlast
+                    pc += 2
+            else:
+                yield from self.nodes[code[pc + 1]].iter_render(scope, last)
+                pc += 2
+
+    def tree(self):
+        """Rebuild the tree of nodes from the tape, with the source positions."""
+        code = self.code
+        positions = self.positions
+        root = node = Container()
+        stack = []  # (enclosing node, position where the current node ends, or None for a Rep)
+        pc = 0
+        nextposition = 0  # Index into positions of the next node with a position.
+        while True:
+            while stack and stack[-1][1] == pc:
+                node = stack.pop()[0]
+            if pc >= len(code):
+                return root
+            op = code[pc]
+            start = pc
+            if op == OP_LIT:
+                child = Lit(self.literals[code[pc + 1]])
+                node.append(child)
+                pc += 2
+            elif op == OP_SUB or op == OP_ESCAPE:
+                child = Sub(self.accessors[code[pc + 1]].path)
+                child.escape = op == OP_ESCAPE
+                node.append(child)
+                pc += 2
+            elif op == OP_NODE:
+                node.append(self.nodes[code[pc + 1]])  # Kept as it was, with its position.
+                pc += 2
+                continue
+            elif op == OP_NEXT:
+                node = stack.pop()[0]
+                pc += 2
+                continue
+            else:
+                if op == OP_SEP:
+                    child, end, pc = Sep("sep"), code[pc + 1], pc + 2
+                elif op == OP_REP:
+                    child, end, pc = Rep(self.accessors[code[pc + 1]].path), None, pc + 4
+                else:
+                    child, end, pc = Cond(self.accessors[code[pc + 1]].path, op == OP_IFNOT), code[pc + 2], pc + 3
+                node.append(child)
+                stack.append((node, end))
+                node = child
+            if nextposition < len(positions) and positions[nextposition] == start:
+                child.line = positions[nextposition + 1]
+                child.col = positions[nextposition + 2]
+                nextposition += 3
+
+
+class Tracer(object):
+    """Instrumentation for rendering. Attach a tracer to a template (Paulatemplate(..., tracer=...) or tem.tracer = ...)
+    and enter() and exit() are called for every node that renders. Without a tracer, rendering isn't slowed down at all.
+    Traced nodes collect their output before passing it on, so the measured times don't include the consumer's time."""
+
+    def enter(self, node, vars):
+        """Called before 'node' renders with the variables 'vars'."""
+
+    def exit(self, node, elapsed, size):
+        """Called after 'node' rendered 'size' characters of output in 'elapsed' seconds, including its children."""
+
+    def trace(self, node, vars, last):
+        """Render 'node' and report it. Returns the list of output chunks."""
+        self.enter(node, vars)
+        start = time.perf_counter()
+        chunks = list(node.iter_render(vars, last, self))
+        elapsed = time.perf_counter() - start
+        self.exit(node, elapsed, sum(map(len, chunks)))
+        return chunks
+
+
+class PrintTracer(Tracer):
+    """Prints an indented trace of the rendering."""
+
+    def __init__(self, file=None):
+        self.file = file
+        self.level = 0
+
+    def enter(self, node, vars):
+        print("%s%s vars=%r" % ("|   " * self.level, node.label(), vars), file=self.file or sys.stdout)
+        self.level += 1
+
+    def exit(self, node, elapsed, size):
+        self.level -= 1
+        print("%s%s: %d characters in %.6f sec" % ("|   " * self.level, node.label(), size, elapsed), file=self.file or sys.stdout)
+
+
+class Profiler(Tracer):
+    """Collects the number of calls, the cumulative time and the output size of every node, over any number of renders.
+    report() lists the nodes by their source position, hottest first."""
+
+    def __init__(self):
+        self.stats = {}  # id(node) -> [node, calls, cumulative time, output size]
+        self.depth = 0
+
+    def enter(self, node, vars):
+        self.depth += 1
+
+    def exit(self, node, elapsed, size):
+        self.depth -= 1
+        stat = self.stats.get(id(node))
+        if stat is None:
+            stat = self.stats[id(node)] = [node, 0, 0.0, 0]
+        stat[1] += 1
+        stat[2] += elapsed
+        stat[3] += size
+
+    def report(self, limit=20, file=None):
+        """Print the 'limit' nodes with the largest cumulative time."""
+        stats = sorted(self.stats.values(), key=lambda stat: stat[2], reverse=True)
+        print("%10s %12s %12s  %s" % ("calls", "cumtime", "chars", "node"), file=file or sys.stdout)
+        for node, calls, cumtime, size in stats[:limit]:
+            print("%10d %12.6f %12d  %s" % (calls, cumtime, size, node.label()), file=file or sys.stdout)
+
+
+class Environment(object):
+    """The configuration that templates are compiled and rendered with, so templates with different settings can be
+    used side by side, e.g. in different threads. A template keeps the environment it was made with.
+
+        exceptionless   True: insert an error in the output text when something is wrong with the template;
+                        False: raise an exception instead
+        autoescape      HTML-escape the values that {=name} substitutes, unless they're Markup; {~name} substitutes
+                        a value as it is
+        whitespace      None, or trim the whitespace of the template text when compiling: "lines", "collapse" or
+                        "html", see trimwhitespace()
+        backend         the default backend of the templates, see Paulatemplate
+        tracer          the default tracer of the templates, see Tracer
+        fragmentcache   the FragmentCache of the {%...} blocks, by default a new LRUFragmentCache
+        loader          a TemplateLoader for get_template() and the {>name} includes
+    """
+
+    def __init__(self, exceptionless=True, autoescape=False, whitespace=None, backend="codegen", tracer=None, fragmentcache=None,
+                 loader=None):
+        if backend not in ("codegen", "tree", "tape"):
+            raise ValueError("Unknown backend %r" % backend)
+        if whitespace not in (None, "lines", "collapse", "html"):
+            raise ValueError("Unknown whitespace mode %r" % whitespace)
+        self.exceptionless = exceptionless
+        self.autoescape = autoescape
+        self.whitespace = whitespace
+        self.backend = backend
+        self.tracer = tracer
+        self.fragmentcache = fragmentcache if fragmentcache is not None else LRUFragmentCache()
+        self.loader = loader
+        if loader is not None:
+            loader.env = self
+
+    def options(self):
+        """The settings that change the compiled template tree, e.g. for the keys of a DiskCache."""
+        return "exceptionless=%d autoescape=%d whitespace=%s" % (self.exceptionless, self.autoescape, self.whitespace)
+
+    def derive(self, **settings):
+        """Return a copy of this environment with some settings changed. It shares the fragment cache and the loader."""
+        env = Environment.__new__(Environment)
+        env.__dict__.update(self.__dict__)
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise TypeError("Unknown setting %r" % name)
+            setattr(env, name, value)
+        return env
+
+    def from_string(self, source, name=None):
+        """Return a template compiled from 'source' in this environment."""
+        return Paulatemplate(source, name, env=self)
+
+    def get_template(self, name):
+        """Return the template 'name' from the loader of this environment."""
+        if self.loader is None:
+            raise ValueError("The environment has no loader")
+        return self.loader.get_template(name)
+
+    def bind(self, root):
+        """Bind the {%...} blocks in a compiled template tree to the fragment cache of this environment."""
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Fragment):
+                node.cache = self.fragmentcache
+            stack.extend(child for child in node if isinstance(child, Container))
+
+    def __getstate__(self):
+        # The loader and the tracer stay behind, e.g. when a template is sent to a worker process.
+        state = self.__dict__.copy()
+        state["loader"] = None
+        state["tracer"] = None
+        return state
+
+
+defaultenvironment = Environment()
+
+
 class Paulatemplate(object):
     """Simple templating class."""
 
-    def __init__(self, s=None, name=None):
-        """Initialize a template, optionally from a template string."""
+    def __init__(self, s=None, name=None, backend=None, tracer=None, autoescape=None, env=None):
+        """Initialize a template, optionally from a template string, in the Environment 'env' (the default
+        environment when None).
+        backend "codegen" renders through a generated Python function, "tree" through the node interpreter,
+        and "tape" through the interpreter of a Tape, which keeps the template in much less memory.
+        A 'tracer' (see Tracer) makes rendering go through the node interpreter and reports every node to it.
+        With 'autoescape', the values that {=name} substitutes are HTML-escaped, unless they're Markup;
+        {~name} substitutes a value as it is.
+        'backend', 'tracer' and 'autoescape' override the settings of the environment."""
+        env = env or defaultenvironment
+        if autoescape is not None and autoescape != env.autoescape:
+            env = env.derive(autoescape=autoescape)
+        backend = backend or env.backend
+        if backend not in ("codegen", "tree", "tape"):
+            raise ValueError("Unknown backend %r" % backend)
+        self.env = env
+        self.backend = backend
+        self.tracer = tracer if tracer is not None else env.tracer
+        self.name = name
+        self.defaults = None  # Constants that a specialized template still needs at render time, see specialize().
         if s:
-            self.root = process(s)
+            self.setroot(process(s, env))
         elif s is not None:
-            self.root = Container()
-            self.root.append(Lit(""))
+            root = Container()
+            root.append(Lit(""))
+            self.setroot(root)
         else:
-            self.root = None
-        self.name = name
+            self.setroot(None)
+
+    def setroot(self, root, code=None):
+        """Install a compiled template tree, and generate its render function when using the codegen backend.
+        'code' is the already compiled code of the render function, e.g. from a DiskCache.
+        The tape backend keeps only the Tape made from the tree, until something needs the tree (see root)."""
+        if root is not None:
+            self.env.bind(root)
+        self.tree = root if self.backend != "tape" else None
+        self.tape = Tape(root) if root is not None and self.backend == "tape" else None
+        self.code = None
+        self.func = None
+        self.parts = None
+        self.strict = None  # The validator and the strict render function, made on first use by render_strict().
+        if root is not None and self.backend == "codegen":
+            self.code = code or gencompile(root, self.name)
+            if self.code:
+                self.func = makefunction(self.code, self.env)
+
+    @property
+    def root(self):
+        """The compiled template tree. With the tape backend it's rebuilt from the tape on first use, e.g. for
+        tracing, and kept from then on, so that a Profiler sees the same nodes in every render."""
+        if self.tree is None and self.tape is not None:
+            self.tree = self.tape.tree()
+        return self.tree
+
+    def checkloaded(self):
+        if self.tree is None and self.tape is None:
+            raise Exception("You should either pass a template as a string in the constructor, or use 'fromfile' to read the template from file")
 
     def fromfile(self, fn):
         """Load a template from a file.
         Allows: tem = Paulatemplate().fromfile("hello.tpl")
         The template file should contain UTF-8 encoded unicode text
         """
-        self.root = process(codecs.open(fn, "r", "utf8").read())
         self.name = fn.replace(" ", "_")
+        self.setroot(process(readfile(fn), self.env))
         return self
 
     def pprint(self):
         """Pretty-print the template structure."""
         pprint.pprint(self.root)
 
+    def specialize(self, **constants):
+        """Return a new template that renders like this one with the template variables 'constants' added,
+        e.g. the settings of a site. What depends only on the constants is rendered once, here (see optimize()).
+        Constants that are still needed inside Reps are added to the variables at render time."""
+        self.checkloaded()
+        root = optimize(self.root, constants)
+        template = Paulatemplate(name=self.name, backend=self.backend, tracer=self.tracer, env=self.env)
+        template.defaults = dict((name, constants[name]) for name in root.allnames() if name in constants) or None
+        template.setroot(root)
+        return template
+
+    def withdefaults(self, vars):
+        """Add the constants that a specialized template still needs to the variables."""
+        if not self.defaults:
+            return vars
+        if not isinstance(vars, collections.abc.Mapping):
+            raise TypeError("Template %s needs its variables as a mapping, to add the constants %s" % (self.name, ", ".join(sorted(self.defaults))))
+        merged = dict(vars)
+        merged.update(self.defaults)
+        return merged
+
+    def iter_render(self, vars):
+        """Renders the template using the supplied variables, yielding the output in chunks as it is produced."""
+        self.checkloaded()
+        vars = self.withdefaults(vars)
+        if self.tracer:
+            return iter(self.tracer.trace(self.root, vars, False))
+        if self.func:
+            return self.func(vars)
+        if self.tape is not None:
+            return self.tape.run(vars)
+        return self.tree.iter_render(vars)
+
     def render(self, vars):
         """Renders the template to a string, using the supplied variables."""
-        if verbose:
-            print("\nRender phase")
-        if not self.root:
-            raise Exception("You should either pass a template as a string in the constructor, or use 'fromfile' to read the template from file")
-        result = self.root.render(vars)
-        if verbose:
-            print("Render result:", result)
-        return result
+        return "".join(self.iter_render(vars))
+
+    def variables(self):
+        """Return the schema of the variables that the template uses: a dict of names to Variables."""
+        self.checkloaded()
+        return self.root.variables()
+
+    def strictfunctions(self):
+        """Return the validator (see genvalidator()) and the strict render function (None except with the codegen
+        backend), making them on first use."""
+        if self.strict is None:
+            root = self.root
+            code = gencompile(root, self.name, strict=True) if self.backend == "codegen" else None
+            self.strict = (genvalidator(root.variables(), self.name), makefunction(code, self.env) if code else None)
+        return self.strict
+
+    def validate(self, vars):
+        """Check the variables against the schema of the template, much faster than rendering it. Returns the list
+        of the required variables that are missing, like "rows[3].title", which is empty when rendering can't
+        run into missing variables."""
+        self.checkloaded()
+        return self.strictfunctions()[0](self.withdefaults(vars))
+
+    def render_strict(self, vars):
+        """Renders the template like render(), after validating the variables: when some are missing, a ValueError
+        that lists them is raised before anything is rendered. With the codegen backend the template then renders
+        without handling missing variables at all; a variable that is missing anyway (in the items of an iterator,
+        which can't be validated in advance) raises a ValueError too."""
+        self.checkloaded()
+        validate, func = self.strictfunctions()
+        merged = self.withdefaults(vars)
+        missing = validate(merged)
+        if missing:
+            raise ValueError("Missing template variables: %s" % ", ".join(missing))
+        if func is None or self.tracer:
+            return self.render(vars)
+        return "".join(func(merged))
+
+    def iter_bytes(self, vars, encoding="utf-8", blocksize=4096):
+        """Renders the template like iter_render(), but yields the output as bytes in 'encoding'. Every 'blocksize'
+        chunks of output are joined and encoded at once, which is faster than encoding each chunk, and faster than
+        encoding all of the output at the end. The blocks can be handed to socket.sendmsg() or writelines() as they are."""
+        chunks = self.iter_render(vars)
+        while True:
+            block = list(itertools.islice(chunks, blocksize))
+            if not block:
+                return
+            yield "".join(block).encode(encoding)
+
+    def render_bytes(self, vars, encoding="utf-8"):
+        """Renders the template to bytes in 'encoding', without making the str output first."""
+        return b"".join(self.iter_bytes(vars, encoding))
+
+    def render_into(self, buffer, vars, encoding="utf-8"):
+        """Renders the template as bytes in 'encoding' into 'buffer' from its start, and returns the number of bytes.
+        A bytearray is resized to the output, reusing the memory it already has, so one buffer can serve many renders.
+        A writable memoryview keeps its size, and a ValueError is raised when the output doesn't fit."""
+        pos = 0
+        if isinstance(buffer, bytearray):
+            for block in self.iter_bytes(vars, encoding):
+                end = pos + len(block)
+                buffer[pos:end] = block
+                pos = end
+            del buffer[pos:]
+        else:
+            size = len(buffer)
+            for block in self.iter_bytes(vars, encoding):
+                end = pos + len(block)
+                if end > size:
+                    raise ValueError("The output doesn't fit in the buffer of %d bytes" % size)
+                buffer[pos:end] = block
+                pos = end
+        return pos
+
+    def renderrecords(self, records):
+        """Render a sequence of (index, vars) records to a list of strings. Failures raise a RenderError with the index."""
+        results = []
+        for index, vars in records:
+            try:
+                results.append(self.render(vars))
+            except Exception as e:
+                raise RenderError(index, "%s: %s" % (e.__class__.__name__, e)) from e
+        return results
+
+    def render_many(self, records, workers=None, chunksize=64):
+        """Render the template for every set of variables in the iterable 'records', yielding the results in order.
+        The work is spread over 'workers' processes (default: one per CPU), which get the template once
+        and the records in chunks of 'chunksize'. Only a few chunks per worker are in flight at any time,
+        so 'records' can be a long-running generator. With workers=1 everything is rendered in this process.
+        A record that fails raises a RenderError that tells its index."""
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            for index, vars in enumerate(records):
+                yield self.renderrecords([(index, vars)])[0]
+            return
+        import concurrent.futures
+        pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=_initworker, initargs=(self,))
+        try:
+            pending = collections.deque()
+            records = enumerate(records)
+            while True:
+                chunk = list(itertools.islice(records, chunksize))
+                if chunk:
+                    pending.append(pool.submit(_renderchunk, chunk))
+                if pending and (not chunk or len(pending) >= 2 * workers):
+                    yield from pending.popleft().result()
+                elif not chunk:
+                    break
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def partfunction(self, container, repbody=False):
+        """Return a render function for a sub-container of the template, for render_parallel()."""
+        code = gencompile(container, self.name, repbody) if self.backend == "codegen" else None
+        if code:
+            return makefunction(code, self.env)
+        if repbody:
+            return lambda item, last, vars, loop: container.iter_render(Scope(item, Scope(vars), loop), last)
+        return container.iter_render
+
+    def getparts(self):
+        """Split the top level of the template into parts for render_parallel(): a (Rep, body function, function)
+        triple for every top-level Rep, and a (None, None, function) triple for every run of other nodes in between.
+        The body function renders the body of the Rep for one item, see codegen()."""
+        if self.parts is None:
+            parts = []
+            root = self.root
+            nodes = root if not isinstance(root, Lit) else [root]
+            for node in nodes:
+                if isinstance(node, Rep):
+                    body = Container()
+                    body.extend(node)
+                    whole = Container()
+                    whole.append(node)
+                    parts.append((node, self.partfunction(body, repbody=True), self.partfunction(whole)))
+                else:
+                    if not parts or parts[-1][0] is not None:
+                        parts.append((None, None, Container()))
+                    parts[-1][2].append(node)
+            self.parts = [(rep, body, whole if rep is not None else self.partfunction(whole)) for rep, body, whole in parts]
+        return self.parts
+
+    def renderpart(self, partindex, items, final, start, vars):
+        """Render the body of the top-level Rep in part 'partindex' for each of 'items', which start at index 'start'
+        of all its items. 'final' tells whether the last of these items is the last item of the whole Rep.
+        'vars' has the template variables that the body may use from the enclosing scope."""
+        body = self.getparts()[partindex][1]
+        output = []
+        loop = Loop()
+        lastnr = len(items) - 1
+        for nr, item in enumerate(items):
+            loop.index0 = start + nr
+            loop.last = last = final and nr == lastnr
+            output.extend(body(item, last, vars, loop))
+        return "".join(output)
+
+    def render_parallel(self, vars, workers=None, executor="process", chunksize=10000):
+        """Renders the template to a string like render(), but renders the items of large top-level Reps in parallel.
+        The items of such a Rep (a sequence of more than 'chunksize' items) are divided into slices of 'chunksize'
+        items, which are rendered by 'workers' processes (executor="process") or threads (executor="thread").
+        The output is the same as that of render()."""
+        import concurrent.futures
+        self.checkloaded()
+        vars = self.withdefaults(vars)
+        workers = workers or os.cpu_count() or 1
+        if executor == "process":
+            pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=_initworker, initargs=(self,))
+            task = _renderitems
+        elif executor == "thread":
+            pool = concurrent.futures.ThreadPoolExecutor(workers)
+            task = lambda args: self.renderpart(*args)
+        else:
+            raise ValueError("Unknown executor %r" % executor)
+        output = []
+        try:
+            for partindex, (rep, body, whole) in enumerate(self.getparts()):
+                items = rep.accessor.lookup(vars) if rep is not None else None
+                if isinstance(items, collections.abc.Sequence) and len(items) > chunksize:
+                    n = len(items)
+                    # Only the variables that the body can refer to are sent along with each slice.
+                    outer = {}
+                    for name in rep.allnames():
+                        value = Accessor(name).probe(vars)
+                        if value is not _MISSING:
+                            outer[name] = value
+                    slices = [(partindex, items[start:start + chunksize], start + chunksize >= n, start, outer) for start in range(0, n, chunksize)]
+                    output.extend(pool.map(task, slices))
+                else:
+                    output.extend(whole(vars))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        return "".join(output)
+
+    def __getstate__(self):
+        """Pickle support, e.g. to send the template to worker processes. The render function is sent as marshalled code."""
+        state = self.__dict__.copy()
+        state["code"] = marshal.dumps(self.code) if self.code else None
+        state["func"] = None
+        state["tracer"] = None
+        state["parts"] = None
+        state["strict"] = None
+        if self.tape is not None:
+            state["tree"] = None  # Rebuilt when needed.
+        return state
+
+    def __setstate__(self, state):
+        code = state.pop("code")
+        self.__dict__.update(state)
+        if code:
+            self.code = marshal.loads(code)
+            self.func = makefunction(self.code, self.env)
+        else:
+            self.code = None
+
+    async def iter_render_async(self, vars):
+        """Renders the template using the supplied variables, yielding the output in chunks as it is produced.
+        Variables can have awaitable values, and Reps can iterate over async iterables. The awaitables
+        used in a scope run concurrently, and the output before the first of them is yielded right away."""
+        self.checkloaded()
+        vars = self.withdefaults(vars)
+        root = self.root
+        scope = _asyncscope(vars, [Accessor(name) for name in root.allnames()])
+        try:
+            async for chunk in root.aiter_render(scope):
+                yield chunk
+        finally:
+            scope.cancel()
+
+    async def render_async(self, vars):
+        """Async version of render(), see iter_render_async()."""
+        return "".join([chunk async for chunk in self.iter_render_async(vars)])
+
+    def render_to(self, fileobj, vars, buffer_size=65536):
+        """Renders the template into the writable file-like object 'fileobj', using the supplied variables.
+        The output is collected into writes of about 'buffer_size' characters. Returns the number of characters written."""
+        total = 0
+        pending = []
+        size = 0
+        for chunk in self.iter_render(vars):
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                fileobj.write("".join(pending))
+                total += size
+                pending = []
+                size = 0
+        if pending:
+            fileobj.write("".join(pending))
+            total += size
+        return total
+
+
+class RenderSession(object):
+    """Keeps the output of a template for a set of variables, to update it when some of the variables change.
+    The output is kept in segments, and update() re-renders only the segments that depend on the changed variables:
+
+        session = RenderSession(tem, vars)
+        page = session.output()
+        changes = session.update(dict(cpu=93))
+
+    Every top-level node is a segment, except that Conds (and plain Containers) are split up: each of their children
+    is a segment of its own, rendered under the Conds around it, so a page wrapped in {?user ...} still updates
+    node by node. A Rep or a Fragment is a single segment: its output is re-rendered as a whole.
+
+    With an 'encoding', update() reports the changes for the output encoded in it, for pushing byte ranges."""
+
+    def __init__(self, template, vars, encoding=None):
+        template.checkloaded()
+        self.template = template
+        self.vars = dict(vars)
+        self.encoding = encoding
+        self.parts = []  # (dependencies, render function) for every segment; literals have no render function.
+        self.segments = []
+        root = template.root
+        stack = [(node, ()) for node in reversed(root if not isinstance(root, Lit) else [root])]
+        while stack:
+            node, conds = stack.pop()  # 'conds' are the Conds around the node, outermost first.
+            if isinstance(node, Cond) or node.__class__ is Container:
+                if isinstance(node, Cond):
+                    conds += (node,)
+                stack.extend((child, conds) for child in reversed(node))
+            elif isinstance(node, Lit) and not conds:
+                self.parts.append((frozenset(), None))
+                self.segments.append(node[0])
+            else:
+                whole = inner = Container()
+                for cond in conds:
+                    inner.append(Cond(cond.name, cond.inverting))
+                    inner = inner[0]
+                inner.append(node)
+                self.parts.append((frozenset(whole.dependencies()), template.partfunction(whole)))
+                self.segments.append(self.rendersegment(self.parts[-1][1]))
+        self.sizes = [self.size(segment) for segment in self.segments]  # In characters, or bytes with an encoding.
+
+    def size(self, text):
+        return len(text) if self.encoding is None else len(text.encode(self.encoding))
+
+    def rendersegment(self, func):
+        return "".join(func(self.template.withdefaults(self.vars)))
+
+    def output(self):
+        """The complete output for the current variables."""
+        return "".join(self.segments)
+
+    def update(self, changed):
+        """Set the variables in the mapping 'changed', and re-render the segments that depend on them.
+        Returns the changes to the output as a list of (start, end, text): each replaces output[start:end] with 'text'.
+        Applied in order to the previous output, the changes turn it into the new output. Positions count characters,
+        or with the 'encoding' of the session, bytes of the encoded output: then 'text' is encoded too."""
+        self.vars.update(changed)
+        names = set(changed)
+        changes = []
+        offset = 0
+        for nr, (deps, func) in enumerate(self.parts):
+            size = self.sizes[nr]
+            if func is not None and not deps.isdisjoint(names):
+                new = self.rendersegment(func)
+                if new != self.segments[nr]:
+                    self.segments[nr] = new
+                    self.sizes[nr] = self.size(new)
+                    changes.append((offset, offset + size, new if self.encoding is None else new.encode(self.encoding)))
+                    offset += self.sizes[nr]
+                    continue
+            offset += size
+        return changes
+
+
+class RenderError(Exception):
+    """Raised by Paulatemplate.render_many() when one of the records fails to render. 'index' is the position of that record."""
+
+    def __init__(self, index, message):
+        super(RenderError, self).__init__(index, message)
+        self.index = index
+        self.message = message
+
+    def __str__(self):
+        return "record %d: %s" % (self.index, self.message)
+
+
+_workertemplate = None  # The template that a render_many() worker process renders.
+
+
+def _initworker(template):
+    global _workertemplate
+    _workertemplate = template
+
+
+def _renderchunk(chunk):
+    """Render a list of (index, vars) records in a worker process."""
+    return _workertemplate.renderrecords(chunk)
+
+
+def _renderitems(args):
+    """Render a slice of the items of a top-level Rep in a render_parallel() worker process."""
+    return _workertemplate.renderpart(*args)
+
+
+def readfile(fn):
+    """Read the UTF-8 encoded source of a template file."""
+    with codecs.open(fn, "r", "utf8") as f:
+        return f.read()
+
+
+class DiskCache(object):
+    """Persistent cache of compiled templates in a directory, so new processes can skip compiling them.
+    Entries are keyed by a hash of the template source, the compile options and the library version. An entry holds the pickled
+    template tree and the marshalled code of its render function, so the directory must only be writable
+    by trusted users. Entries that can't be read back are ignored, and the template is compiled again."""
+
+    magic = b"PTPL"
+    formatversion = 5  # Bump when the pickled node classes change.
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.header = self.magic + struct.pack("<H", self.formatversion) + importlib.util.MAGIC_NUMBER
+
+    def key(self, source, env=None):
+        options = (env or defaultenvironment).options()
+        return hashlib.sha256(("%s\0%s\0%s" % (__version__, options, source)).encode("utf8")).hexdigest()
+
+    def filename(self, source, env=None):
+        return os.path.join(self.directory, self.key(source, env) + ".ptc")
+
+    def load(self, source, name=None, backend=None, env=None):
+        """Return the cached template for 'source' compiled in the Environment 'env', or None when it isn't cached
+        or the entry is unusable."""
+        try:
+            with open(self.filename(source, env), "rb") as f:
+                data = f.read()
+            if not data.startswith(self.header):
+                return None
+            pos = len(self.header)
+            (codesize,) = struct.unpack_from("<I", data, pos)
+            pos += 4
+            code = marshal.loads(data[pos:pos + codesize]) if codesize else None
+            root = pickle.loads(data[pos + codesize:])
+            template = Paulatemplate(name=name, backend=backend, env=env)
+            template.setroot(root, code)
+        except Exception:
+            return None
+        return template
+
+    def dump(self, source, template):
+        """Store the compiled 'template' for 'source'. The file is replaced atomically."""
+        codebytes = marshal.dumps(template.code) if template.code else b""
+        data = self.header + struct.pack("<I", len(codebytes)) + codebytes + pickle.dumps(template.root, pickle.HIGHEST_PROTOCOL)
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmpname, self.filename(source, template.env))
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+    def get(self, source, name=None, backend=None, env=None):
+        """Return the compiled template for 'source', from the cache or compiled and then stored in the cache."""
+        template = self.load(source, name, backend, env)
+        if template is None:
+            template = Paulatemplate(source, name, backend=backend, env=env)
+            self.dump(source, template)
+        return template
+
+
+def precompile(directory, cache_dir, pattern="*", env=None):
+    """Compile all template files below 'directory' whose name matches 'pattern' into the DiskCache in 'cache_dir',
+    with the settings of the Environment 'env'. Returns the number of templates."""
+    cache = DiskCache(cache_dir)
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for fn in fnmatch.filter(filenames, pattern):
+            source = readfile(os.path.join(dirpath, fn))
+            if cache.load(source, env=env) is None:
+                cache.dump(source, Paulatemplate(source, os.path.join(dirpath, fn).replace(" ", "_"), env=env))
+            count += 1
+    return count
+
+
+def main(argv):
+    """Command line interface: python -m paulatemplate precompile <dir> --cache-dir <cachedir>"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m paulatemplate")
+    commands = parser.add_subparsers(dest="command", required=True)
+    cmd = commands.add_parser("precompile", help="compile template files into a cache directory")
+    cmd.add_argument("directory", help="directory with template files, searched recursively")
+    cmd.add_argument("--cache-dir", required=True, help="directory of the compiled template cache")
+    cmd.add_argument("--pattern", default="*", help="shell pattern for the template filenames (default: all files)")
+    cmd.add_argument("--autoescape", action="store_true", help="compile the templates with HTML autoescaping")
+    cmd.add_argument("--whitespace", choices=("lines", "collapse", "html"), help="trim the whitespace of the templates")
+    args = parser.parse_args(argv)
+    if args.command == "precompile":
+        count = precompile(args.directory, args.cache_dir, args.pattern, Environment(autoescape=args.autoescape, whitespace=args.whitespace))
+        print("%d templates precompiled into %s" % (count, args.cache_dir))
+    return 0
+
+
+class _CacheEntry(object):
+    """A template in the TemplateLoader cache, with the state of the files it was compiled from:
+    a (filename, mtime, size) triple for its own file, followed by those of the templates it includes."""
+    __slots__ = ("template", "files", "checked")
+
+    def __init__(self, template, files, checked):
+        self.template = template
+        self.files = files
+        self.checked = checked
+
+    def unchanged(self):
+        """Whether none of the files changed since they were read."""
+        for filename, mtime, size in self.files:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return False
+            if (st.st_mtime, st.st_size) != (mtime, size):
+                return False
+        return True
+
+
+class TemplateLoader(object):
+    """Loads templates by name from a list of directories, and keeps the compiled templates in an LRU cache.
+    A cached template is revalidated with an os.stat() of its file (mtime and size) when it was last checked
+    more than 'check_interval' seconds ago. In 'immutable' mode the files are never checked again once loaded.
+    The loader links the templates: {>name} includes the template 'name' from the loader, which is compiled once and
+    then inlined into every template that includes it. A template is reloaded when one of the templates it includes
+    (directly or indirectly) changed. The loader can be shared by many threads."""
+
+    def __init__(self, searchpath, maxsize=256, check_interval=2.0, immutable=False, backend=None, cache_dir=None, env=None):
+        """'cache_dir' optionally names a directory for a DiskCache of compiled templates.
+        The templates are compiled in the Environment 'env'; an Environment made with this loader becomes its environment.
+        'backend' overrides the backend of the environment."""
+        if isinstance(searchpath, str):
+            searchpath = [searchpath]
+        self.searchpath = list(searchpath)
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.immutable = immutable
+        self.backend = backend
+        self.env = env or defaultenvironment
+        self.diskcache = DiskCache(cache_dir) if cache_dir else None
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def find(self, name):
+        """Return the filename of the template 'name' in the first directory of the search path that has it.
+        The name is a relative path with "/" separators; names that could lead out of the search path aren't found."""
+        parts = name.split("/")
+        for part in parts:
+            if part in ("", ".", "..") or os.sep in part or (os.altsep and os.altsep in part) or os.path.splitdrive(part)[0]:
+                raise FileNotFoundError("Template %r not found in %s" % (name, self.searchpath))
+        for directory in self.searchpath:
+            fn = os.path.join(directory, *parts)
+            if os.path.isfile(fn):
+                return fn
+        raise FileNotFoundError("Template %r not found in %s" % (name, self.searchpath))
+
+    def get_template(self, name):
+        """Return the compiled template 'name', from the cache when it's still up to date."""
+        return self.entry(name).template
+
+    def entry(self, name, including=()):
+        """Return the cache entry of the template 'name', which is loaded when it isn't cached or no longer up to date.
+        'including' is the chain of templates that include this one."""
+        if name in including:
+            raise ValueError("Include cycle: %s" % " -> ".join(including + (name,)))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(name)
+            if entry is not None and (self.immutable or now - entry.checked < self.check_interval):
+                self.cache.move_to_end(name)
+                self.hits += 1
+                return entry
+        if entry is not None and entry.unchanged():
+            with self.lock:
+                entry.checked = now
+                if name in self.cache:
+                    self.cache.move_to_end(name)
+                self.hits += 1
+            return entry
+        entry = self.load(name, now, including)
+        with self.lock:
+            self.misses += 1
+            self.cache[name] = entry
+            self.cache.move_to_end(name)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def load(self, name, now, including=()):
+        """Read, compile and link a template file into a new cache entry.
+        The DiskCache, when there is one, has the template as it is before linking."""
+        fn = self.find(name)
+        st = os.stat(fn)
+        source = readfile(fn)
+        if self.diskcache:
+            template = self.diskcache.get(source, fn.replace(" ", "_"), self.backend, self.env)
+        else:
+            template = Paulatemplate(source, fn.replace(" ", "_"), backend=self.backend, env=self.env)
+        files = [(fn, st.st_mtime, st.st_size)]
+
+        def resolve(partial):
+            entry = self.entry(partial, including + (name,))
+            files.extend(entry.files)
+            return entry.template.root
+
+        root = optimize(template.root, resolve=resolve)
+        if len(files) > 1:
+            template.setroot(root)
+        return _CacheEntry(template, tuple(dict.fromkeys(files)), now)
+
+    def stats(self):
+        """Return the cache counters."""
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, size=len(self.cache))
+
+    def clear(self):
+        """Empty the cache."""
+        with self.lock:
+            self.cache.clear()
 
 
 class Test(unittest.TestCase):
     """Unittest for Paulatemplate."""
 
+    def assertRenders(self, tems, temv, expected):
+        """Check that every backend renders the template source 'tems' with variables 'temv' to 'expected'."""
+        for backend in ("tree", "codegen", "tape"):
+            tem = Paulatemplate(tems, backend=backend)
+            self.assertEqual(tem.render(temv), expected, "backend %s, template %r" % (backend, tems))
+
     def test_naming(self):
         """Test the naming; every template instance can have a name (usually the filename where it was loaded from).
         This name is used in error reporting."""
@@ -349,17 +2488,16 @@ class Test(unittest.TestCase):
     def test_badmetachar(self):
         tems = "{&name}"  # Note that '&' is illegal after a '{'.
         #
-        global exceptionless
-        prevexceptionless = exceptionless
+        self.assertRaises(ValueError, Paulatemplate, tems, env=Environment(exceptionless=False))
         #
-        exceptionless = False
-        self.assertRaises(ValueError, Paulatemplate, tems)
-        #
-        exceptionless = True
         tem = Paulatemplate(tems)
         res = tem.render({})
         self.assertTrue("Template error" in res)
-        exceptionless = prevexceptionless
+        # So do bad options, with their position.
+        tems = "a\n {%key=x ttl=soon {=x}}b"
+        self.assertRaisesRegex(ValueError, "^Bad fragment option 'ttl=soon' at line 2, column 2$", Paulatemplate, tems, env=Environment(exceptionless=False))
+        res = Paulatemplate(tems).render(dict(x=1))
+        self.assertTrue(res.startswith("a\n <span") and res.endswith("Template error: Bad fragment option &#x27;ttl=soon&#x27; at line 2, column 2</span>b"), res)
 
     def test_splitting(self):
         self.assertEqual(splitfirst(""), ("", ""))
@@ -401,8 +2539,7 @@ class Test(unittest.TestCase):
             )
 
         for tems, temv, expected in goodcases:
-            tem = Paulatemplate(tems)
-            self.assertEqual(tem.render(temv), expected)
+            self.assertRenders(tems, temv, expected)
 
     def test_simplerepetitions(self):
         goodcases = (
@@ -454,8 +2591,7 @@ class Test(unittest.TestCase):
                 "sell 2 stocks: APPL &euro; 320, GOOG &euro; 120"),
             )
         for tems, temv, expected in goodcases:
-            tem = Paulatemplate(tems)
-            self.assertEqual(tem.render(temv), expected)
+            self.assertRenders(tems, temv, expected)
 
 
     def test_conditions(self):
@@ -481,8 +2617,7 @@ class Test(unittest.TestCase):
                 "A!!C!D!E"),
             )
         for tems, temv, expected in goodcases:
-            tem = Paulatemplate(tems)
-            self.assertEqual(tem.render(temv), expected)
+            self.assertRenders(tems, temv, expected)
 
 
     def test_complex(self):
@@ -522,8 +2657,7 @@ class Test(unittest.TestCase):
             )
 
         for tems, temv, expected in goodcases:
-            tem = Paulatemplate(tems)
-            self.assertEqual(tem.render(temv), expected)
+            self.assertRenders(tems, temv, expected)
 
 
     ''' Unittest broken? Or am I lost?
@@ -535,10 +2669,9 @@ class Test(unittest.TestCase):
             ("{=a", dict(a=42)), # missing closing {
             )
 
-        global exceptionless
-        exceptionless = False
+        env = Environment(exceptionless=False)
         for tems, temv in badcases:
-            self.assertRaises(Exception, Paulatemplate(tems).render(temv))
+            self.assertRaises(Exception, Paulatemplate(tems, env=env).render(temv))
     '''
 
     def test_namedtuple(self):
@@ -548,75 +2681,650 @@ class Test(unittest.TestCase):
         tem = Paulatemplate("{#phonebook {=name} {=telephone}{/sep , }}")
         self.assertEqual(tem.render(dict(phonebook=phonebook)), "Mary 0203898, Jan 0683928")
 
+    def test_streaming(self):
+        import io
+        tems = "<ul>{#items <li>{=name}</li>}</ul>"
+        temv = dict(items=[dict(name="n%d" % nr) for nr in range(100)])
+        for backend in ("tree", "codegen", "tape"):
+            tem = Paulatemplate(tems, backend=backend)
+            chunks = list(tem.iter_render(temv))
+            self.assertTrue(len(chunks) > 100)
+            self.assertEqual("".join(chunks), tem.render(temv))
+            writes = []
+            class Sink(object):
+                write = writes.append
+            self.assertEqual(tem.render_to(Sink(), temv, buffer_size=100), len(tem.render(temv)))
+            self.assertEqual("".join(writes), tem.render(temv))
+            self.assertTrue(all(len(write) >= 100 for write in writes[:-1]))
+            f = io.StringIO()
+            tem.render_to(f, temv)
+            self.assertEqual(f.getvalue(), tem.render(temv))
+        self.assertEqual(list(Paulatemplate("").iter_render({})), [])
+
+    def test_loader(self):
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        with tempfile.TemporaryDirectory() as d1, tempfile.TemporaryDirectory() as d2:
+            def write(directory, name, text, mtime):
+                fn = os.path.join(directory, name)
+                with open(fn, "w") as f:
+                    f.write(text)
+                os.utime(fn, (mtime, mtime))
+            write(d1, "a.tpl", "A{=x}", 1000)
+            write(d2, "a.tpl", "shadowed", 1000)
+            write(d2, "b.tpl", "B{=x}", 1000)
+            loader = TemplateLoader([d1, d2], maxsize=2, check_interval=0)
+            self.assertEqual(loader.get_template("a.tpl").render(dict(x=1)), "A1")
+            self.assertEqual(loader.get_template("b.tpl").render(dict(x=2)), "B2")
+            self.assertIs(loader.get_template("a.tpl"), loader.get_template("a.tpl"))
+            self.assertEqual(loader.stats(), dict(hits=2, misses=2, evictions=0, size=2))
+            # A changed file is picked up.
+            write(d1, "a.tpl", "AA{=x}", 2000)
+            self.assertEqual(loader.get_template("a.tpl").render(dict(x=1)), "AA1")
+            # Least recently used is evicted.
+            write(d1, "c.tpl", "C", 1000)
+            loader.get_template("c.tpl")
+            self.assertEqual(loader.stats()["evictions"], 1)
+            self.assertEqual(list(loader.cache), ["a.tpl", "c.tpl"])
+            self.assertRaises(FileNotFoundError, loader.get_template, "nope.tpl")
+            # Names can't lead out of the search path.
+            os.mkdir(os.path.join(d1, "sub"))
+            write(d1, "sub/s.tpl", "S", 1000)
+            self.assertEqual(TemplateLoader(d1).get_template("sub/s.tpl").render({}), "S")
+            for name in ("../" + os.path.basename(d1) + "/a.tpl", "sub/../a.tpl", "./a.tpl", "sub//s.tpl", "/a.tpl", os.path.join(d1, "a.tpl")):
+                self.assertRaises(FileNotFoundError, TemplateLoader(os.path.join(d1, "sub")).get_template, name)
+                self.assertRaises(FileNotFoundError, loader.get_template, name)
+            # Immutable loaders never look at the file again.
+            loader = TemplateLoader(d1, immutable=True)
+            tem = loader.get_template("a.tpl")
+            write(d1, "a.tpl", "changed", 3000)
+            self.assertIs(loader.get_template("a.tpl"), tem)
+            # Concurrent access.
+            loader = TemplateLoader([d1, d2], check_interval=0)
+            with ThreadPoolExecutor(8) as pool:
+                results = list(pool.map(lambda nr: loader.get_template("b.tpl").render(dict(x=nr)), range(200)))
+            self.assertEqual(results, ["B%d" % nr for nr in range(200)])
+            stats = loader.stats()
+            self.assertEqual(stats["hits"] + stats["misses"], 200)
+
+    def test_includes(self):
+        with tempfile.TemporaryDirectory() as d:
+            def write(name, text, mtime=1000):
+                fn = os.path.join(d, name)
+                with open(fn, "w") as f:
+                    f.write(text)
+                os.utime(fn, (mtime, mtime))
+            os.mkdir(os.path.join(d, "partials"))
+            write("page", "<h1>{>partials/header}</h1><ul>{#rows {>partials/row}}</ul>")
+            write("other", "{>partials/row}{>partials/row}")
+            write("partials/header", "Hi {=name}{>partials/sub}")
+            write("partials/sub", "!")
+            write("partials/row", "<li>{=x}{=name}</li>")
+            write("cycle", "a{>partials/cycle}")
+            write("partials/cycle", "b{>cycle}")
+            for backend in ("codegen", "tree", "tape"):
+                loader = TemplateLoader(d, check_interval=0, backend=backend, cache_dir=os.path.join(d, "cache"))
+                page = loader.get_template("page")
+                temv = dict(name="Joe", rows=[dict(x=1), dict(x=2, name="Mary")])
+                self.assertEqual(page.render(temv), "<h1>Hi Joe!</h1><ul><li>1Joe</li><li>2Mary</li></ul>")
+                self.assertEqual(page.root[0], Lit("<h1>Hi "))  # Inlined, and merged with the literals around it.
+                self.assertEqual(loader.get_template("other").render(dict(x=3)), ("<li>3" + _errorspan("Sub", "name") + "</li>") * 2)
+                self.assertEqual(loader.stats()["misses"], 5)  # Every template is compiled once.
+                self.assertRaises(ValueError, loader.get_template, "cycle")
+                # A change to an included template reloads the templates that include it.
+                write("partials/sub", "?", 2000)
+                self.assertEqual(page.render(temv), "<h1>Hi Joe!</h1><ul><li>1Joe</li><li>2Mary</li></ul>")
+                self.assertEqual(loader.get_template("page").render(temv), "<h1>Hi Joe?</h1><ul><li>1Joe</li><li>2Mary</li></ul>")
+                write("partials/sub", "!", 1000)
+            write("escape", "{>../" + os.path.basename(d) + "/partials/sub}")
+            self.assertRaises(FileNotFoundError, TemplateLoader(os.path.join(d, "partials")).get_template, "../escape")
+            self.assertRaises(FileNotFoundError, TemplateLoader(d).get_template, "escape")
+            self.assertEqual(Paulatemplate("{>partials/row}").render({}), Include("partials/row").error())
+
+    def test_diskcache(self):
+        import subprocess
+        with tempfile.TemporaryDirectory() as d:
+            cachedir = os.path.join(d, "cache")
+            source = "{#a {=b}{/sep , }}"
+            cache = DiskCache(cachedir)
+            self.assertIsNone(cache.load(source))
+            tem = cache.get(source, "t")
+            self.assertTrue(os.path.exists(cache.filename(source)))
+            loaded = cache.load(source, "t")
+            self.assertIsNot(loaded, tem)
+            self.assertTrue(callable(loaded.func))
+            temv = dict(a=[dict(b=1), dict(b=2)])
+            self.assertEqual(loaded.render(temv), "1, 2")
+            self.assertEqual(cache.load(source, backend="tree").render(temv), "1, 2")
+            # Corrupt entries are recompiled silently.
+            with open(cache.filename(source), "r+b") as f:
+                f.seek(len(cache.header) + 4)
+                f.write(b"garbage")
+            self.assertIsNone(cache.load(source))
+            self.assertEqual(cache.get(source).render(temv), "1, 2")
+            self.assertIsNotNone(cache.load(source))
+            # Precompiling from the command line, then loading through a TemplateLoader.
+            tpldir = os.path.join(d, "templates")
+            os.makedirs(os.path.join(tpldir, "sub"))
+            with open(os.path.join(tpldir, "sub", "x.tpl"), "w") as f:
+                f.write("X{=x}")
+            out = subprocess.check_output([sys.executable, "-m", "paulatemplate", "precompile", tpldir, "--cache-dir", cachedir],
+                                          cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertIn(b"1 templates precompiled", out)
+            self.assertIsNotNone(cache.load("X{=x}"))
+            loader = TemplateLoader(tpldir, cache_dir=cachedir)
+            self.assertEqual(loader.get_template("sub/x.tpl").render(dict(x=3)), "X3")
+
+    def test_parsing(self):
+        self.assertEqual(lexer("a{=b}{?c d{=e}}f"), ["a", "{", "=b", "}", "{", "?c d", "{", "=e", "}", "}", "f"])
+        self.assertEqual(lexer(iter("x{y}")), ["x", "{", "y", "}"])
+        self.assertEqual(parse(lexer("a{=b}{?c d{=e}}f")), ["a", ["=b"], ["?c d", ["=e"]], "f"])
+        self.assertRaises(Exception, parse, lexer("a}"))
+        root = process("line one\n  {?c x\n {=y}}")
+        cond = root[1]
+        self.assertEqual((cond.line, cond.col), (2, 3))
+        self.assertEqual((cond[1].line, cond[1].col), (3, 2))
+        # Nesting far deeper than the recursion limit.
+        depth = sys.getrecursionlimit() * 2
+        root = process("{?c " * depth + "x" + "}" * depth)
+        for level in range(depth + 1):
+            root = root[-1]
+        self.assertEqual(root, Lit("x"))
+
+    def test_tracing(self):
+        import io
+        tems = "Hi {=name}!\n{#items {=nr}{/sep , }}{?flag yes}"
+        temv = dict(name="Joe", items=[dict(nr=1), dict(nr=2), dict(nr=3)], flag=False)
+        profiler = Profiler()
+        tem = Paulatemplate(tems, tracer=profiler)
+        for nr in range(2):
+            self.assertEqual(tem.render(temv), "Hi Joe!\n1, 2, 3")
+        bylabel = dict((stat[0].label(), stat[1:]) for stat in profiler.stats.values())
+        self.assertEqual(bylabel["1:4 Sub name"][0], 2)
+        self.assertEqual(bylabel["2:1 Rep items"][0], 2)
+        self.assertEqual(bylabel["2:1 Rep items"][2], 2 * len("1, 2, 3"))
+        self.assertEqual(bylabel["2:9 Sub nr"][0], 6)
+        self.assertEqual(bylabel["2:14 Sep sep"][0], 6)
+        self.assertEqual(bylabel["- Container"][2], 2 * len("Hi Joe!\n1, 2, 3"))
+        report = io.StringIO()
+        profiler.report(file=report)
+        self.assertEqual(report.getvalue().splitlines()[1].split()[-1], "Container")
+        # The tape backend keeps the tree it rebuilds for tracing, with the source positions.
+        tapeprofiler = Profiler()
+        tem = Paulatemplate(tems, backend="tape", tracer=tapeprofiler)
+        for nr in range(3):
+            self.assertEqual(tem.render(temv), "Hi Joe!\n1, 2, 3")
+        bylabel = dict((stat[0].label(), stat[1:]) for stat in tapeprofiler.stats.values())
+        self.assertEqual((bylabel["1:4 Sub name"][0], bylabel["2:9 Sub nr"][0]), (3, 9))
+        self.assertIs(tem.root, tem.root)
+        tem.tracer = profiler
+        # The plain trace.
+        out = io.StringIO()
+        tem.tracer = PrintTracer(out)
+        self.assertEqual(tem.render(temv), "Hi Joe!\n1, 2, 3")
+        self.assertIn("|   |   2:9 Sub nr vars={'nr': 1}", out.getvalue())
+        tem.tracer = None
+        self.assertEqual(tem.render(temv), "Hi Joe!\n1, 2, 3")
+
+    def test_render_many(self):
+        tem = Paulatemplate("{=nr}: {#items {=x}{/sep , }}")
+        records = [dict(nr=nr, items=[dict(x=x) for x in range(nr % 4)]) for nr in range(300)]
+        expected = [tem.render(record) for record in records]
+        self.assertEqual(list(tem.render_many(records, workers=1)), expected)
+        self.assertEqual(list(tem.render_many(iter(records), workers=2, chunksize=7)), expected)
+        copy = pickle.loads(pickle.dumps(tem))
+        self.assertTrue(callable(copy.func))
+        self.assertEqual(copy.render(records[5]), expected[5])
+        records[123] = dict(nr=123, items=5)  # Not iterable.
+        for workers in (1, 2):
+            with self.assertRaises(RenderError) as cm:
+                list(tem.render_many(records, workers=workers, chunksize=10))
+            self.assertEqual(cm.exception.index, 123)
+            self.assertIn("TypeError", str(cm.exception))
+
+    def test_render_parallel(self):
+        tems = "<h1>{=title}</h1>{#rows <td>{=x}</td>{/sep ,\n}}<p>{#missing x}</p>{#small {=x}{/sep ;}}"
+        temv = dict(title="T", rows=[dict(x=nr) for nr in range(1000)], small=[dict(x=1), dict(x=2)])
+        for backend in ("codegen", "tree", "tape"):
+            tem = Paulatemplate(tems, backend=backend)
+            expected = tem.render(temv)
+            self.assertTrue(expected.endswith("<td>999</td><p>" + _errorspan("Rep", "missing") + "</p>1;2"))
+            for executor in ("thread", "process"):
+                self.assertEqual(tem.render_parallel(temv, workers=3, executor=executor, chunksize=64), expected)
+            self.assertEqual(tem.render_parallel(dict(temv, rows=[]), executor="thread"), tem.render(dict(temv, rows=[])))
+            self.assertEqual(Paulatemplate("a{#r }b", backend=backend).render_parallel(dict(r=[1, 2]), executor="thread"), "ab")
+        self.assertRaises(ValueError, tem.render_parallel, temv, executor="bogus")
+
+    def test_async(self):
+        started = []
+
+        async def value(result, delay=0.01):
+            started.append(result)
+            await asyncio.sleep(delay)
+            return result
+
+        async def rows(n):
+            for nr in range(n):
+                await asyncio.sleep(0)
+                yield dict(nr=value(nr), double=nr * 2)
+
+        tems = "{=a} {=b} {=a}{?flag !}{!flag ?} {#rows {=nr}:{=double}{/sep , }}{#plain {=x}}{#none x}{=unused}"
+
+        async def main():
+            temv = dict(a=value("A"), b=value("B", 0.02), flag=value(True), rows=rows(3), plain=value([dict(x="p")]), none=value([]))
+            start = time.perf_counter()
+            result = await Paulatemplate(tems).render_async(temv)
+            return result, time.perf_counter() - start
+
+        result, duration = asyncio.run(main())
+        self.assertEqual(result, "A B A! 0:0, 1:2, 2:4p" + _errorspan("Sub", "unused"))
+        self.assertLess(duration, 0.1)  # The awaitables of a scope run concurrently.
+        self.assertEqual(sorted(map(repr, started[:5])), sorted(map(repr, ["A", "B", True, [dict(x="p")], []])))
+
+        async def stream():
+            tem = Paulatemplate("first {=slow} last")
+            chunks = []
+            start = time.perf_counter()
+            async for chunk in tem.iter_render_async(dict(slow=value("slow", 0.1))):
+                chunks.append((chunk, time.perf_counter() - start))
+            return chunks
+
+        chunks = asyncio.run(stream())
+        self.assertEqual([chunk for chunk, elapsed in chunks], ["first ", "slow", " last"])
+        self.assertLess(chunks[0][1], 0.05)  # Flushed before the slow value is available.
+        tem = Paulatemplate("{#rows {=loop.index}{=nr}{=unit}{/sep ,}}")
+        result = asyncio.run(tem.render_async(dict(unit=value("kg"), rows=rows(2))))
+        self.assertEqual(result, "10kg,21kg")
+
+    def test_lazy_rep(self):
+        self.assertEqual(list(_lookahead([])), [])
+        self.assertEqual(list(_lookahead("a")), [("a", True)])
+        self.assertEqual(list(_lookahead(iter("abc"))), [("a", False), ("b", False), ("c", True)])
+        consumed = []
+
+        def rows(n):
+            for nr in range(n):
+                consumed.append(nr)
+                yield dict(nr=nr)
+
+        self.assertRenders("{#rows {=nr}{/sep , }}", dict(rows=rows(0)), "")
+        for backend in ("tree", "codegen", "tape"):
+            tem = Paulatemplate("{#rows {=nr}{/sep , }}", backend=backend)
+            self.assertEqual(tem.render(dict(rows=rows(4))), "0, 1, 2, 3")
+            self.assertEqual(tem.render(dict(rows=(row for row in [dict(nr=1)]))), "1")
+            # The rows are consumed while the output is produced.
+            consumed[:] = []
+            chunks = tem.iter_render(dict(rows=rows(1000)))
+            next(chunks)
+            self.assertLess(len(consumed), 3)
+
+    def test_dotted_names(self):
+        import collections
+        Person = collections.namedtuple("Person", ["firstname", "lastname", "address"])
 
-def test_performance():
-    """Paulatemplate and Jinja2 go head-to-head!
-    Result for nr=150 on my MacBook Air:
-        Paulatemplate: 467MB produced in 66.237 sec
-        Jinja2: 470MB produced in 156.205 sec
-    """
-    import time
-    nr = 2
-    books = []
-    d = {"books": books}
-    for booknr in range(nr):
-        chapters = []
-        book = dict(title="%d bottles of beer" % booknr, toc="This will be the table of contents.", chapters=chapters)
-        books.append(book)
-        for chapternr in range(nr):
-            sections = []
-            chapter = dict(title="%d. How to drink beer" % chapternr, intro="This will be an intro", sections=sections)
-            chapters.append(chapter)
-            for sectionnr in range(nr):
-                section = dict(title="%d. Procedure" % sectionnr, text="This will be an explanation of how to drink beer.")
-                sections.append(section)
-    tem = Paulatemplate("""
-        {#books
-            <h1>The Book Of {=title}</h1>
-            <p>{=toc}</p>
-            {#chapters
-                <h2>Chapter {=title}</h2>
-                <p>{=intro}</p>
-                {#sections
-                    <h3>Section {=title}</h3>
-                    <p>{=text}</p>
-                }
+        class Address(object):
+            def __init__(self, city):
+                self.city = city
+
+        mary = Person("Mary", "Jones", Address("Leiden"))
+        temv = dict(person=mary, people=[mary, Person("Jan", "Smit", None)], table=[["a", "b"], ["c", "d"]],
+                    nested=dict(inner=dict(value=42)), flags=dict(on=True))
+        goodcases = (
+            ("{=person.lastname}, {=person.firstname}", temv, "Jones, Mary"),
+            ("{=person.address.city}", temv, "Leiden"),
+            ("{=nested.inner.value}", temv, "42"),
+            ("{=table.1.0}{=table.-1.1}", temv, "cd"),
+            ("{#people {=firstname}{?address  in {=address.city}}{/sep , }}", temv, "Mary in Leiden, Jan"),
+            ("{#table {=0}}", temv, "ac"),
+            ("{?flags.on yes}{!flags.off no}", temv, "yesno"),
+            ("{=person.age}", temv, _errorspan("Sub", "person.age")),
+            ("{=table.5}", temv, _errorspan("Sub", "table.5")),
+            ("{#person.nope x}", temv, _errorspan("Rep", "person.nope")),
+            )
+        for tems, temv, expected in goodcases:
+            self.assertRenders(tems, temv, expected)
+        accessor = Accessor("a.0")
+        self.assertEqual(accessor(dict(a=["x"])), "x")
+        self.assertEqual(accessor(dict(a={"0": "y"})), "y")
+        self.assertEqual(set(accessor.steps[0].getters), set([dict]))
+        self.assertEqual(pickle.loads(pickle.dumps(accessor)).path, "a.0")
+
+    def test_scopes(self):
+        temv = dict(currency="EUR", user=dict(name="Joe"), show=True,
+                    orders=[dict(nr=1, lines=[dict(price=3), dict(price=4, currency="USD")]),
+                            dict(nr=2, lines=[dict(price=5)], user=dict(name="Mary"))])
+        goodcases = (
+            ("{#orders {=nr} for {=user.name}: {#lines {=price} {=currency}{/sep , }}{/sep ; }}", temv,
+                "1 for Joe: 3 EUR, 4 USD; 2 for Mary: 5 EUR"),
+            ("{#orders {?show {=nr}}{#lines {?show x}}}", temv, "1xx2x"),
+            ("{#orders {#lines {=unknown}}}", temv, _errorspan("Sub", "unknown") * 3),
+            ("{#orders {=loop.index}/{=loop.index0}{?loop.first F}{?loop.last L}{#lines  {=loop.index}}|}", temv,
+                "1/0F 1 2|2/1L 1|"),
+            ("{=loop}", dict(loop="top level"), "top level"),
+            ("{#names {=loop.index}. {=name}{/sep , }}", dict(names=tuple(dict(name=n) for n in "abc")), "1. a, 2. b, 3. c"),
+            # An item's own 'loop' comes before the Loop.
+            ("{#rows [{=loop}]{?loop.first F}}", dict(rows=[dict(loop="x")]), "[x]"),
+            ("{#rows {=loop.index}{#inner {=loop.index}}}", dict(rows=[dict(loop=dict(index="own"), inner=[{}]), dict(inner=[dict(loop=dict(index="mine"))])]), "own12mine"),
+            )
+        for tems, temv, expected in goodcases:
+            self.assertRenders(tems, temv, expected)
+        tem = Paulatemplate("{#rows {=loop.index}:{=x}{=suffix}{/sep ,}}")
+        temv = dict(rows=[dict(x=nr) for nr in range(100)], suffix="!")
+        for executor in ("thread", "process"):
+            self.assertEqual(tem.render_parallel(temv, workers=2, executor=executor, chunksize=7), tem.render(temv))
+
+    def test_optimize(self):
+        root = process("a{?x}b{/sep}c{?y d{!z}e}{=f}")
+        self.assertEqual([node.__class__.__name__ for node in root], ["Lit", "Cond", "Sub"])
+        self.assertEqual(root[0], Lit("abc"))
+        self.assertEqual(root[1][0], Lit("de"))
+        self.assertRenders("{?x}", dict(), "")
+        site = Paulatemplate("<title>{=site.name}</title>{?beta <b>beta</b>}{!beta <i>stable</i>}"
+                             "<ul>{#menu <li>{=label}{?loop.last .}</li>}</ul>"
+                             "{#items {=name} {=currency}{/sep , }}{?user hi {=user}}", name="site")
+        for backend in ("codegen", "tree", "tape"):
+            site.backend = backend
+            site.setroot(site.root)
+            constants = dict(site=dict(name="Shop"), beta=False, menu=[dict(label="Home"), dict(label="Cart")], currency="EUR")
+            tem = site.specialize(**constants)
+            self.assertEqual(tem.backend, backend)
+            self.assertEqual(tem.root[0], Lit("<title>Shop</title><i>stable</i><ul><li>Home</li><li>Cart.</li></ul>"))
+            self.assertEqual(tem.defaults, dict(currency="EUR"))
+            temv = dict(items=[dict(name="a"), dict(name="b", currency="USD")], user="Joe")
+            expected = site.render(dict(temv, **constants))
+            self.assertEqual(tem.render(temv), expected)
+            self.assertEqual(tem.render_parallel(temv, executor="thread", chunksize=1), expected)
+            self.assertRaises(TypeError, tem.render, collections.namedtuple("Vars", "items user")([], "Joe"))
+        # A Rep that also needs variables that aren't constants is left as it is.
+        tem = Paulatemplate("{#menu {=label}{=suffix}}").specialize(menu=[dict(label="Home")])
+        self.assertIsInstance(tem.root[0], Rep)
+        self.assertEqual(tem.render(dict(suffix="!")), "Home!")
+
+    def test_fragments(self):
+        calls = []
+
+        class Product(object):
+            def __init__(self, nr):
+                self.nr = nr
+
+            @property
+            def title(self):
+                calls.append(self.nr)
+                return "product %d" % self.nr
+
+        for backend in ("tree", "codegen", "tape"):
+            env = Environment(backend=backend, fragmentcache=LRUFragmentCache(maxsize=3))
+            tem = env.from_string("{#products {%key=product.nr <b>{=product.title}</b>{/sep , }}}")
+            self.assertEqual(tem.root[0][0].keys[0].path, "product.nr")
+            temv = dict(products=[dict(product=Product(nr)) for nr in (1, 2, 1)])
+            del calls[:]
+            self.assertEqual(tem.render(temv), "<b>product 1</b>, <b>product 2</b>, <b>product 1</b>")
+            self.assertEqual(calls, [1, 2, 1])  # The last item has no separator, so it's a different fragment.
+            self.assertEqual(tem.render(temv), "<b>product 1</b>, <b>product 2</b>, <b>product 1</b>")
+            self.assertEqual(calls, [1, 2, 1])
+            self.assertEqual(env.fragmentcache.stats(), dict(hits=3, misses=3, evictions=0, expirations=0, size=3))
+            # Expired fragments, and key values that can't be hashed.
+            tem = env.from_string("{%key=product.nr,x ttl=0 {=product.title}}")
+            del calls[:]
+            for nr in range(2):
+                self.assertEqual(tem.render(dict(product=Product(3), x=[1])), "product 3")
+                self.assertEqual(tem.render(dict(product=Product(4))), "product 4")
+            self.assertEqual(calls, [3, 4, 3, 4])
+            self.assertEqual(env.fragmentcache.stats()["expirations"], 1)
+            self.assertEqual(env.fragmentcache.stats()["evictions"], 1)
+        env = Environment()
+        tem = env.from_string("{%key=x [{=x}]}")
+        for nr in range(2):
+            self.assertEqual(asyncio.run(tem.render_async(dict(x=1))), "[1]")
+        self.assertEqual(env.fragmentcache.stats()["hits"], 1)
+        # Fragments that differ only in a Cond being inverted don't share their cache entries.
+        for backend in ("tree", "codegen", "tape"):
+            env = Environment(backend=backend)
+            self.assertEqual(env.from_string("{%key=k {?x YES}}").render(dict(k=1, x=True)), "YES")
+            self.assertEqual(env.from_string("{%key=k {!x YES}}").render(dict(k=1, x=True)), "")
+
+    def test_session(self):
+        tems = "<h1>{=title}</h1>{?alert <b>{=alert}</b>}<ul>{#rows <li>{=name}: {=value}{=unit}</li>}</ul>{=cpu}%"
+        temv = dict(title="Dashboard", alert=None, unit="ms", cpu=12, rows=[dict(name="a", value=1), dict(name="b", value=2)])
+        tem = Paulatemplate(tems)
+        self.assertEqual(tem.root[5].dependencies(), set(["rows", "name", "value", "unit"]))
+        for backend in ("codegen", "tree", "tape"):
+            tem = Paulatemplate(tems, backend=backend)
+            session = RenderSession(tem, temv)
+            self.assertEqual(session.output(), tem.render(temv))
+            for changed in (dict(cpu=93), dict(alert="hot", unit="s"), dict(title="Dashboard"), dict(cpu=93, rows=[])):
+                previous = session.output()
+                changes = session.update(changed)
+                expected = tem.render(dict(session.vars))
+                self.assertEqual(session.output(), expected)
+                for start, end, text in changes:
+                    previous = previous[:start] + text + previous[end:]
+                self.assertEqual(previous, expected)
+            self.assertEqual(session.update(dict(cpu=5)), [(len(expected) - 3, len(expected) - 1, "5")])
+            self.assertEqual(session.update(dict(unrelated=1)), [])
+        # Byte ranges of the encoded output.
+        tem = Paulatemplate("é{=a}ü{=b}")
+        session = RenderSession(tem, dict(a="x", b="z"), encoding="utf-8")
+        self.assertEqual(session.update(dict(a="y", b="€")), [(2, 3, b"y"), (5, 6, "€".encode("utf-8"))])
+        self.assertEqual(session.update(dict(b="w")), [(5, 8, b"w")])
+        self.assertEqual(RenderSession(tem, dict(a="x")).update(dict(a="y")), [(1, 2, "y")])
+        # A page in a top-level Cond is still updated node by node, until the condition changes.
+        tems = "{?user <h1>{=user}</h1>{!quiet {=cpu}%}{#rows {=name}}}"
+        temv = dict(user="Joe", cpu=12, rows=[dict(name="a")])
+        for backend in ("codegen", "tree", "tape"):
+            tem = Paulatemplate(tems, backend=backend)
+            session = RenderSession(tem, temv)
+            self.assertEqual(session.output(), "<h1>Joe</h1>12%a")
+            self.assertEqual(session.update(dict(cpu=93)), [(12, 14, "93")])
+            self.assertEqual(session.update(dict(quiet=True)), [(12, 14, ""), (12, 13, "")])
+            self.assertEqual(session.update(dict(user=None, quiet=False)), [(0, 4, ""), (0, 3, ""), (0, 5, ""), (0, 1, "")])
+            self.assertEqual(session.output(), tem.render(dict(session.vars)))
+
+    def test_tape(self):
+        root = process("a{=b}{?c x{/sep ,}}{#r {=x}{!y no}{#z [{=loop.index}]}}{%key=b <{=b}>}{=b}")
+        tape = Tape(root)
+        self.assertEqual(tape.tree(), root)
+        self.assertEqual([accessor.path for accessor in tape.accessors], ["b", "c", "r", "x", "y", "z", "loop.index"])
+        self.assertEqual(tape.nodes, (root[4],))
+        self.assertEqual(tape.names, (("x",), ()))
+        tem = Paulatemplate("{=b}", backend="tape")
+        self.assertIsNone(tem.tree)
+        self.assertEqual(pickle.loads(pickle.dumps(tem)).render(dict(b=1)), "1")
+        # Unlike generated code, the tape has no nesting limit.
+        depth = sys.getrecursionlimit() * 2
+        tem = Paulatemplate("{?c " * depth + "{=x}" + "}" * depth, backend="tape")
+        self.assertEqual(tem.render(dict(c=True, x=5)), "5")
+        self.assertEqual(tem.render(dict(x=5)), "")
+
+    def test_bytes(self):
+        import io
+        tems = "Grüße {=name}: {#rows {=x}{/sep , }}{%key=name [{=name}]}{=missing}"
+        temv = dict(name="Zoë", rows=[dict(x=nr) for nr in range(50)] + [dict(x="€")])
+        for backend in ("codegen", "tree", "tape"):
+            tem = Paulatemplate(tems, backend=backend)
+            expected = tem.render(temv).encode("utf-8")
+            self.assertEqual(tem.render_bytes(temv), expected)
+            self.assertEqual(tem.render_bytes(dict(temv, rows=[]), "latin-1"), tem.render(dict(temv, rows=[])).encode("latin-1"))
+            self.assertRaises(UnicodeEncodeError, tem.render_bytes, temv, "latin-1")
+            blocks = list(tem.iter_bytes(temv, blocksize=10))
+            self.assertGreater(len(blocks), 10)
+            out = io.BytesIO()
+            out.writelines(blocks)
+            self.assertEqual(out.getvalue(), expected)
+            buffer = bytearray(b"x" * 1000)
+            self.assertEqual(tem.render_into(buffer, temv), len(expected))
+            self.assertEqual(buffer, expected)
+            self.assertEqual(tem.render_into(buffer, dict(temv, rows=[])), len(buffer))
+            memory = memoryview(bytearray(len(expected)))
+            self.assertEqual(tem.render_into(memory, temv), len(expected))
+            self.assertEqual(memory.tobytes(), expected)
+            self.assertRaises(ValueError, tem.render_into, memory[:10], temv)
+
+    def test_autoescape(self):
+        tems = "<p title=\"{=title}\">{=body}{~body} {=safe}{=n}{=none}{=missing}{?x {=body}}{#rows [{=v}]}{%key=body {=body}}</p>"
+        temv = dict(title='"Q&A"', body="<b>", safe=Markup("<i>ok</i>"), n=5, none=None, x=True, rows=[dict(v="a<b")])
+        expected = ('<p title="&quot;Q&amp;A&quot;">&lt;b&gt;<b> <i>ok</i>5' + _errorspan("Sub", "missing") +
+                    "&lt;b&gt;[a&lt;b]&lt;b&gt;</p>")
+        for backend in ("codegen", "tree", "tape"):
+            tem = Paulatemplate(tems, backend=backend, autoescape=True)
+            self.assertEqual(tem.render(temv), expected)
+            self.assertEqual(asyncio.run(tem.render_async(temv)), expected)
+            self.assertEqual(tem.specialize(body="<b>").render(temv), expected)
+            self.assertEqual(Paulatemplate(tems, backend=backend).render(temv).count("<b>"), 4)
+
+        class Html(object):
+            def __html__(self):
+                return "<hr>"
+
+        self.assertEqual(Paulatemplate("{=x}", autoescape=True).render(dict(x=Html())), "<hr>")
+        with tempfile.TemporaryDirectory() as d:
+            cache = DiskCache(d)
+            self.assertEqual(cache.get("{=x}", env=Environment(autoescape=True)).render(dict(x="<")), "&lt;")
+            self.assertEqual(cache.get("{=x}").render(dict(x="<")), "<")
+            self.assertEqual(cache.load("{=x}", env=Environment(autoescape=True)).render(dict(x="<")), "&lt;")
+
+    def test_environment(self):
+        """Templates in different environments render side by side in threads, each with its own settings."""
+        escaping = Environment(autoescape=True, fragmentcache=LRUFragmentCache(maxsize=10))
+        plain = Environment(backend="tape")
+        tems = "{%key=n {=x}}{#rows [{=x}]}"
+        templates = [escaping.from_string(tems), plain.from_string(tems), Paulatemplate(tems, env=escaping, backend="tree")]
+        self.assertEqual([tem.backend for tem in templates], ["codegen", "tape", "tree"])
+        self.assertIs(templates[2].root[0].cache, escaping.fragmentcache)
+        expected = ["&lt;x&gt;[&lt;x&gt;][&lt;x&gt;]", "<x>[<x>][<x>]", "&lt;x&gt;[&lt;x&gt;][&lt;x&gt;]"]
+        results = []
+
+        def work(tem, want):
+            for nr in range(200):
+                result = tem.render(dict(n=nr % 5, x="<x>", rows=[{}, {}]))
+                if result != want:
+                    results.append(result)
+
+        threads = [threading.Thread(target=work, args=args) for args in zip(templates, expected) for nr in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [])
+        self.assertEqual(escaping.fragmentcache.stats()["size"], 5)  # Shared by both templates of the environment.
+        self.assertEqual(plain.fragmentcache.stats()["size"], 5)
+        # The autoescape argument derives an environment, and a pickled template keeps its settings.
+        tem = pickle.loads(pickle.dumps(Paulatemplate("{=x}", autoescape=True, env=plain)))
+        self.assertEqual((tem.backend, tem.render(dict(x="<"))), ("tape", "&lt;"))
+        self.assertFalse(plain.autoescape)
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "page"), "w") as f:
+                f.write("{=x}")
+            env = Environment(autoescape=True, loader=TemplateLoader(d))
+            self.assertEqual(env.get_template("page").render(dict(x="&")), "&amp;")
+        self.assertRaises(ValueError, plain.get_template, "page")
+        self.assertRaises(TypeError, plain.derive, verbose=True)
+
+    def test_whitespace(self):
+        tems = "<ul>\n    {#items\n        <li>  {=x}  </li>  \n\n    }\n</ul>\n<pre>\n  {=x}\n  y</pre> <b> </b>"
+        temv = dict(x="  a  b  ", items=[{}, {}])
+        expected = {
+            "lines": "<ul>\n<li>    a  b    </li>\n<li>    a  b    </li>\n</ul>\n<pre>\n  a  b  \ny</pre> <b> </b>",
+            "collapse": "<ul>  <li>   a  b   </li>  <li>   a  b   </li>  </ul> <pre>   a  b   y</pre> <b> </b>",
+            "html": "<ul>  <li>   a  b   </li>  <li>   a  b   </li>  </ul> <pre>\n    a  b  \n  y</pre> <b> </b>",
             }
-        }
-        """)
-    start = time.time()
-    res = tem.render(d)
-    dur = time.time() - start
-    print("paulatemplate: %dMB produced in %.3f sec:" % (len(res) / 1024 / 1024, dur))
-    if nr < 3:
-        print(res)
-    #
-    from jinja2 import Template
-    tem = Template("""
-        {% for book in books %}
-            <h1>The Book Of {{book.title}}</h2>
-            <p>{{book.toc}}</p>
-            {% for chapter in book.chapters %}
-                <h2>Chapter {{chapter.title}}</h2>
-                <p>{{chapter.intro}}</p>
-                {% for section in chapter.sections %}
-                    <h3>Section {{section.title}}</h3>
-                    <p>{{section.text}}</p>
-                {% endfor %}
-            {% endfor %}
-        {% endfor %}
-        """)
-    start = time.time()
-    res = tem.render(dict(books=books))
-    dur = time.time() - start
-    print("jinja2: %dMB produced in %.3f sec:" % (len(res) / 1024 / 1024, dur))
-    if nr < 3:
-        print(res)
+        for mode in expected:
+            for backend in ("tree", "codegen", "tape"):
+                tem = Environment(whitespace=mode, backend=backend).from_string(tems)
+                self.assertEqual(tem.render(temv), expected[mode], "mode %s, backend %s" % (mode, backend))
+        # The <pre> element spans literals, and constants aren't trimmed.
+        tem = Environment(whitespace="html").from_string("<PRE class=x>{?a  {=x}\n }</pre>  {=y}  ")
+        self.assertEqual(repr(tem.root), repr(process("<PRE class=x>{?a  {=x}\n }</pre> {=y} ")))
+        self.assertEqual(tem.specialize(y="  c  ").render(dict(a=True, x=1)), "<PRE class=x> 1\n </pre>   c   ")
+        # Whitespace-only literals disappear.
+        tem = Environment(whitespace="lines").from_string("<ul>\n  {#a\n    <li>{=b}</li>\n  }\n</ul>\n")
+        self.assertEqual(repr(tem.root[1]), "Rep a: [Lit: ['<li>'], Sub b: [], Lit: ['</li>\\n']]")
+        self.assertRaises(ValueError, Environment, whitespace="all")
+        with tempfile.TemporaryDirectory() as d:
+            cache = DiskCache(d)
+            self.assertEqual(cache.get("a  b").render({}), "a  b")
+            self.assertEqual(cache.get("a  b", env=Environment(whitespace="collapse")).render({}), "a b")
+
+    def test_columns(self):
+        class Array(object):
+            """Enough of a NumPy array for Columns."""
+            def __init__(self, values, kind):
+                self.values = values
+                self.dtype = collections.namedtuple("dtype", "kind")(kind)
+
+            def __len__(self):
+                return len(self.values)
+
+            def astype(self, type):
+                return Array([type(value) + "!" for value in self.values], "U")  # Marked, to see that it's used.
+
+            def tolist(self):
+                return list(self.values)
+
+        tems = "{#rows {=id}:{=name}{?flag *}{#tags [{=tag}|{=id}]}{/sep , }}"
+        rows = Columns(dict(id=Array([1, 2, 3], "i"), name=["a", None, 3.5], flag=Array([0, 1, 0], "i"),
+                            tags=[[], [dict(tag="t")], []], unused=[object()] * 3))
+        self.assertEqual(Rep("rows").textnames(), ())
+        self.assertEqual(process(tems)[0].textnames(), ("id", "name", "tag"))
+        self.assertRenders(tems, dict(rows=rows), "1!:a, 2!:*[t|2!], 3!:3.5")
+        self.assertEqual(Paulatemplate(tems).render(dict(rows=list(rows))), "1:a, 2:*[t|2], 3:3.5")
+        self.assertEqual(asyncio.run(Paulatemplate(tems).render_async(dict(rows=rows))), "1:a, 2:*[t|2], 3:3.5")
+        self.assertRenders("{#rows {=loop.index}{=x}}", dict(rows=Columns(dict(x=["<"])), x=1), "1<")
+        self.assertRenders("[{#rows x}]", dict(rows=Columns({})), "[]")
+        self.assertRaises(ValueError, Columns, dict(a=[1], b=[]))
+
+    def test_variables(self):
+        tems = "{=title}{?user.admin !}{=user.name}{#rows {=id}{?flag *}{#tags [{=tag}{=title}]}{=loop.index}}{%key=k .}"
+        tem = Paulatemplate(tems)
+        schema = tem.variables()
+        self.assertEqual(sorted(schema), ["k", "rows", "title", "user"])
+        self.assertEqual([schema[name].kind for name in sorted(schema)], ["tested", "iterated", "scalar", "object"])
+        self.assertEqual(repr(schema["rows"]), "rows: iterated items=[flag: tested, id: scalar, tags: iterated items=[tag: scalar, title: scalar]]")
+        self.assertEqual(repr(schema["user"]), "user: object children=[admin: tested, name: scalar]")
+        self.assertEqual((schema["k"].required, schema["user"].required), (False, True))
+        temv = dict(title="T", user=dict(name="joe"), rows=[dict(id=1, tags=[dict(tag="a")]), dict(id=2, flag=True, tags=[])])
+        for backend in ("tree", "codegen", "tape"):
+            tem = Paulatemplate(tems, backend=backend)
+            self.assertEqual(tem.validate(temv), [])
+            self.assertEqual(tem.render_strict(temv), tem.render(temv))
+            self.assertEqual(tem.validate(dict(user=None, rows=[dict(tags=[{}, dict(tag=1)])])),
+                             ["rows[0].id", "rows[0].tags[0].tag", "rows[0].tags[0].title", "rows[0].tags[1].title", "title", "user.name"])
+            self.assertRaisesRegex(ValueError, "Missing template variables: rows, title$", tem.render_strict, dict(user=dict(name=1)))
+            # Iterators aren't validated, Columns only by their names.
+            self.assertEqual(tem.validate(dict(temv, rows=iter([{}]))), [])
+            self.assertEqual(tem.validate(dict(temv, rows=Columns(dict(tags=[[]])))), ["rows.id"])
+        # Variables in the bodies of Conds are only needed when the conditions hold, so they aren't required.
+        tems = "Dear {=name}, {?deadline Please be back before {=time}!}{!quiet {#notes {=text}}}"
+        self.assertEqual(repr(Paulatemplate(tems).variables()["time"]), "time: scalar guarded")
+        for backend in ("tree", "codegen", "tape"):
+            tem = Paulatemplate(tems, backend=backend)
+            self.assertEqual(tem.validate(dict(name="Joe", deadline=False, quiet=True)), [])
+            self.assertEqual(tem.render_strict(dict(name="Joe", deadline=False, quiet=True)), "Dear Joe, ")
+            temv = dict(name="Joe", deadline=True, notes=[{}])
+            self.assertEqual(tem.render_strict(temv), tem.render(temv))
+            self.assertEqual(tem.validate(dict(deadline=True)), ["name"])
+        tem = Paulatemplate("{#rows {=id}}")
+        self.assertRaisesRegex(ValueError, "Missing template variable: id", tem.render_strict, dict(rows=iter([{}])))
+        self.assertNotIn("try:", codegen(tem.root, strict=True))
+        self.assertEqual(tem.specialize(id=5).validate(dict(rows=[{}])), [])
+
+    def test_codegen(self):
+        tem = Paulatemplate("{#a {=b}{/sep , }}")
+        self.assertTrue(callable(tem.func))
+        self.assertIsNone(Paulatemplate("{#a {=b}}", backend="tree").func)
+        self.assertRaises(ValueError, Paulatemplate, "x", backend="bogus")
+        # Python limits the nesting of blocks; such templates fall back to the tree interpreter.
+        deep = "{?c " * 120 + "x" + "}" * 120
+        tem = Paulatemplate(deep)
+        self.assertIsNone(tem.func)
+        self.assertEqual(tem.render({"c": True}), "x")
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["precompile"]:
+        # Run from the imported module, so the cached trees pickle as paulatemplate.* instead of __main__.* classes.
+        import paulatemplate
+        sys.exit(paulatemplate.main(sys.argv[1:]))
+
     # For the usual unittests:
     unittest.main()
-
-    # Uncomment for a benchmark comparison:
-    # test_performance()
@@ -0,0 +1,607 @@
+# encoding: utf8
+
+"""Benchmarks for Paulatemplate.
+
+The benchmark suite measures a matrix of scenarios (see 'scenarios') for throughput, latency percentiles and peak
+memory, and compares them with Jinja2 when that's installed:
+
+    python -m paulatemplate_bench run [--json results.json] [--quick] [scenario ...]
+    python -m paulatemplate_bench compare baseline.json results.json [--threshold 10]
+
+'compare' reports the scenarios that got slower or use more memory than the threshold (in percent) allows,
+and exits with status 1 when there are any. The in-depth benchmarks of single features (see 'benchmarks')
+run with:
+
+    python -m paulatemplate_bench compile ...
+"""
+
+import io
+import json
+import math
+import platform
+import sys
+import time
+import unittest
+
+import paulatemplate
+
+
+def best(func, repeat=3):
+    """Run 'func' 'repeat' times and return the fastest duration in seconds."""
+    durations = []
+    for nr in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def legacy_lexer(it):
+    """The character-by-character lexer that Paulatemplate used originally, for comparison."""
+    tokens = []
+    token = ""
+    for c in it:
+        if c == "{":
+            if token:
+                tokens.append(token)
+                token = ""
+            tokens.append(c)
+        elif c == "}":
+            if token:
+                tokens.append(token)
+                token = ""
+            tokens.append(c)
+        else:
+            token += c
+    if token:
+        tokens.append(token)
+    return tokens
+
+
+def legacy_parse(it, node, nesting=0):
+    """The recursive parser that Paulatemplate used originally, for comparison."""
+    for token in it:
+        if token == "{":
+            subnode = []
+            node.append(subnode)
+            legacy_parse(it, subnode, nesting + 1)
+        elif token == "}":
+            if nesting == 0:
+                raise Exception("Unbalanced }")
+            return
+        else:
+            node.append(token)
+
+
+def bench_compile():
+    """Lexing and parsing time of the legacy and the current implementation, for large and for deeply nested sources."""
+    chunk = """
+        <div class="product">
+            <h2>{=title}</h2>
+            {?onsale <span class="sale">On sale!</span>}
+            <ul>{#variants <li>{=size}: {=price}{/sep , }</li>}</ul>
+        </div>
+        """
+    sources = [
+        ("large 1MB", chunk * (2 ** 20 // len(chunk))),
+        ("large 4MB", chunk * (2 ** 22 // len(chunk))),
+        ("deep 500", "{?c " * 500 + "x" + "}" * 500),
+        ]
+    print("%-12s %12s %12s %8s" % ("source", "legacy", "current", "speedup"))
+    for label, source in sources:
+        def legacy():
+            legacy_parse(paulatemplate.feed(legacy_lexer(paulatemplate.feed(source))), [])
+
+        def current():
+            paulatemplate.parse(paulatemplate.lexer(source))
+
+        legacytime = best(legacy)
+        currenttime = best(current)
+        print("%-12s %10.3f s %10.3f s %7.1fx" % (label, legacytime, currenttime, legacytime / currenttime))
+    label, source = "deep 20000", "{?c " * 20000 + "x" + "}" * 20000
+    print("%-12s %12s %10.3f s" % (label, "(too deep)", best(lambda: paulatemplate.process(source))))
+
+
+def bench_parallel(nrows=1000000):
+    """Serial render() against render_parallel() of one huge top-level Rep, checking that the output is identical."""
+    import os
+    tem = paulatemplate.Paulatemplate("<table>\n{#rows <tr><td>{=id}</td><td>{=name}</td><td>{=amount}</td></tr>{/sep \n}}\n</table>")
+    rows = [dict(id=nr, name="customer %d" % nr, amount=nr * 1.25) for nr in range(nrows)]
+    start = time.perf_counter()
+    expected = tem.render(dict(rows=rows))
+    serial = time.perf_counter() - start
+    print("%-22s %8.3f s  %d MB" % ("serial", serial, len(expected) // 2 ** 20))
+    for executor in ("process", "thread"):
+        workers = os.cpu_count() or 1
+        start = time.perf_counter()
+        result = tem.render_parallel(dict(rows=rows), workers=workers, executor=executor, chunksize=nrows // (4 * workers) or 1)
+        duration = time.perf_counter() - start
+        assert result == expected, "render_parallel() output differs from render()"
+        print("%-22s %8.3f s  %.1fx, identical output" % ("%d %s workers" % (workers, executor), duration, serial / duration))
+
+
+def peakmemory(func):
+    """Run 'func' under tracemalloc, returning its duration in seconds and its peak memory use in bytes."""
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        return duration, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class NullWriter(object):
+    "A file-like object that discards what is written to it."
+
+    def write(self, s):
+        pass
+
+
+def bench_lazy(nrows=1000000):
+    """Memory use of a Rep over a lazily produced row source, against materializing the rows into a list first."""
+    tem = paulatemplate.Paulatemplate("{#rows <tr><td>{=id}</td><td>{=name}</td></tr>\n}")
+
+    def rows():
+        for nr in range(nrows):
+            yield dict(id=nr, name="customer %d" % nr)
+
+    def materialized():
+        tem.render_to(NullWriter(), dict(rows=list(rows())))
+
+    def lazy():
+        tem.render_to(NullWriter(), dict(rows=rows()))
+
+    for label, func in (("list of rows", materialized), ("generator", lazy)):
+        duration, peak = peakmemory(func)
+        print("%-14s %8.3f s  peak %8.1f MB" % (label, duration, peak / 2 ** 20))
+
+
+def bench_fragments(nrequests=2000):
+    """Rendering a page with a large navigation menu, with and without caching the menu in a {%...} fragment."""
+    menu = "<nav>{#sections <h3>{=title}</h3><ul>{#links <li><a href=\"{=url}\">{=label}</a></li>}</ul>}</nav>"
+    temv = dict(user="Joe", site="shop", sections=[dict(title="section %d" % nr, links=[dict(url="/%d/%d" % (nr, link), label="link %d" % link)
+                                                                                    for link in range(20)]) for nr in range(10)])
+    env = paulatemplate.Environment()
+    for label, tems in (("uncached", "<p>Hi {=user}</p>" + menu), ("fragment", "<p>Hi {=user}</p>{%key=site " + menu + "}")):
+        tem = env.from_string(tems)
+        duration = best(lambda: [tem.render(temv) for nr in range(nrequests)])
+        print("%-10s %8.1f us/render" % (label, duration / nrequests * 1e6))
+    print(env.fragmentcache.stats())
+
+
+def bench_tape(ntemplates=1000, nrenders=2000):
+    """Memory held by many resident templates, and render throughput, per backend."""
+    import tracemalloc
+    page = """<html><head><title>{=site.name} - {=title}</title></head><body>
+        <div class="header">{?user Welcome back, {=user.name}!}{!user <a href="/login">Log in</a>}</div>
+        <ul class="products">{#products
+            <li class="product{?onsale  sale}">
+                <h2>{=title}</h2>
+                <p>{=description}</p>
+                <span class="price">{=price} {=currency}</span>{?loop.last <hr>}
+            </li>{/sep \n}}
+        </ul>
+        <div class="footer">tenant %d - {=site.name}</div></body></html>"""
+    temv = dict(site=dict(name="Shop"), title="Products", user=dict(name="Joe"), currency="EUR",
+                products=[dict(title="product %d" % nr, description="about product %d" % nr, price=nr * 1.5, onsale=nr % 3 == 0)
+                          for nr in range(20)])
+    print("%-8s %14s %16s" % ("backend", "memory/template", "renders/s"))
+    for backend in ("tree", "codegen", "tape"):
+        sources = [page % nr for nr in range(ntemplates)]
+        tracemalloc.start()
+        templates = [paulatemplate.Paulatemplate(source, backend=backend) for source in sources]
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tem = templates[0]
+        duration = best(lambda: [tem.render(temv) for nr in range(nrenders)])
+        print("%-8s %12.1f KB %16.0f" % (backend, memory / ntemplates / 1024, nrenders / duration))
+
+
+def bench_bytes(nrows=20000, nrenders=20):
+    """Producing UTF-8 output: render().encode() against render_bytes() and render_into() a reused bytearray."""
+    tem = paulatemplate.Paulatemplate("<table>{#rows <tr><td>{=id}</td><td class=\"name\">{=name}</td></tr>\n}</table>")
+    temv = dict(rows=[dict(id=nr, name="customer %d" % nr) for nr in range(nrows)])
+    buffer = bytearray()
+    expected = tem.render(temv).encode("utf-8")
+    for label, func in (("render().encode()", lambda: tem.render(temv).encode("utf-8")),
+                        ("render_bytes()", lambda: tem.render_bytes(temv)),
+                        ("render_into()", lambda: tem.render_into(buffer, temv))):
+        assert func() in (expected, len(expected))
+        duration = best(lambda: [func() for nr in range(nrenders)])
+        peak = peakmemory(func)[1]
+        print("%-18s %8.2f ms/render  peak %6.1f MB" % (label, duration / nrenders * 1000, peak / 2 ** 20))
+
+
+def bench_autoescape(nrows=2000, nrenders=20):
+    """Escaping the whole context in advance, against autoescaping the values the template substitutes."""
+    import html
+    tems = "<table>{#rows <tr><td>{=name}</td><td>{=city}</td></tr>}</table>"
+    temv = dict(rows=[dict(name="customer <%d>" % nr, city="Amsterdam & co", notes="unused " * 20, tags=["a", "b"] * 10)
+                      for nr in range(nrows)])
+
+    def escapeall(value):
+        if isinstance(value, str):
+            return html.escape(value)
+        if isinstance(value, dict):
+            return dict((key, escapeall(item)) for key, item in value.items())
+        if isinstance(value, list):
+            return [escapeall(item) for item in value]
+        return value
+
+    plain = paulatemplate.Paulatemplate(tems)
+    auto = paulatemplate.Paulatemplate(tems, autoescape=True)
+    assert plain.render(escapeall(temv)) == auto.render(temv)
+    for label, func in (("pre-pass", lambda: plain.render(escapeall(temv))), ("autoescape", lambda: auto.render(temv)),
+                        ("no escaping", lambda: plain.render(temv))):
+        print("%-12s %8.2f ms/render" % (label, best(lambda: [func() for nr in range(nrenders)]) / nrenders * 1000))
+
+
+def bench_threads(nrenders=2000):
+    """Renders per second of one shared template and environment in a single thread, against a pool of threads.
+    Threads only add throughput on a free-threaded build of CPython."""
+    import concurrent.futures
+    import os
+    env = paulatemplate.Environment(autoescape=True)
+    tem = env.from_string("<ul>{#products <li class=\"{?onsale sale}\">{=title}: {=price}</li>{/sep \n}}</ul>{%key=site <p>{=site}</p>}")
+    temv = dict(site="shop", products=[dict(title="product <%d>" % nr, price=nr * 1.5, onsale=nr % 3 == 0) for nr in range(50)])
+    expected = tem.render(temv)
+    gil = sys._is_gil_enabled() if hasattr(sys, "_is_gil_enabled") else True
+    print("GIL %s, %d CPUs" % ("enabled" if gil else "disabled", os.cpu_count() or 1))
+    serial = best(lambda: [tem.render(temv) for nr in range(nrenders)])
+    print("%-12s %10.0f renders/s" % ("1 thread", nrenders / serial))
+    for workers in (2, 4, 8):
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            def threaded():
+                results = pool.map(lambda nr: tem.render(temv), range(nrenders))
+                assert all(result == expected for result in results), "threaded output differs"
+            duration = best(threaded)
+        print("%-12s %10.0f renders/s  %.1fx" % ("%d threads" % workers, nrenders / duration, serial / duration))
+
+
+# The nested books/chapters/sections template (formerly test_performance), and the same for Jinja2.
+bookstemplate = """
+    {#books
+        <h1>The Book Of {=title}</h1>
+        <p>{=toc}</p>
+        {#chapters
+            <h2>Chapter {=title}</h2>
+            <p>{=intro}</p>
+            {#sections
+                <h3>Section {=title}</h3>
+                <p>{=text}</p>
+            }
+        }
+    }
+    """
+jinjabookstemplate = """
+    {% for book in books %}
+        <h1>The Book Of {{book.title}}</h1>
+        <p>{{book.toc}}</p>
+        {% for chapter in book.chapters %}
+            <h2>Chapter {{chapter.title}}</h2>
+            <p>{{chapter.intro}}</p>
+            {% for section in chapter.sections %}
+                <h3>Section {{section.title}}</h3>
+                <p>{{section.text}}</p>
+            {% endfor %}
+        {% endfor %}
+    {% endfor %}
+    """
+
+
+def books_data(nr):
+    """The books/chapters/sections variables, with 'nr' items on every level."""
+    return dict(books=[dict(title="%d bottles of beer" % book, toc="This will be the table of contents.",
+                            chapters=[dict(title="%d. How to drink beer" % chapter, intro="This will be an intro",
+                                           sections=[dict(title="%d. Procedure" % section, text="This will be an explanation of how to drink beer.")
+                                                     for section in range(nr)])
+                                      for chapter in range(nr)])
+                       for book in range(nr)])
+
+
+def bench_whitespace(nr=20, nrenders=20):
+    """Output size and render time of the books template, per whitespace mode."""
+    temv = books_data(nr)
+    print("%-10s %10s %8s %12s %8s" % ("mode", "output", "size", "render", "time"))
+    for mode in (None, "lines", "collapse", "html"):
+        tem = paulatemplate.Environment(whitespace=mode).from_string(bookstemplate)
+        size = len(tem.render(temv))
+        duration = best(lambda: [tem.render(temv) for nr in range(nrenders)]) / nrenders
+        if mode is None:
+            basesize, baseduration = size, duration
+        print("%-10s %7.2f MB %7.0f%% %9.1f ms %7.0f%%" % (mode or "none", size / 2 ** 20, 100.0 * size / basesize,
+                                                        duration * 1000, 100.0 * duration / baseduration))
+
+
+def bench_columns(nrows=1000000):
+    """A Rep over columnar data: making a dict for every row first, against Columns over lists and over NumPy arrays."""
+    tem = paulatemplate.Paulatemplate("{#rows <tr><td>{=id}</td><td>{=amount}</td><td>{=name}</td></tr>\n}")
+    ids = list(range(nrows))
+    amounts = [nr * 0.25 for nr in range(nrows)]
+    names = ["customer %d" % nr for nr in range(nrows)]
+
+    def rowdicts():
+        return tem.render(dict(rows=[dict(id=id, amount=amount, name=name) for id, amount, name in zip(ids, amounts, names)]))
+
+    def columns():
+        return tem.render(dict(rows=paulatemplate.Columns(dict(id=ids, amount=amounts, name=names))))
+
+    expected = rowdicts()
+    scenarios = [("row dicts", rowdicts), ("Columns of lists", columns)]
+    try:
+        import numpy
+    except ImportError:
+        print("(NumPy isn't installed, skipping the NumPy arrays)")
+    else:
+        arrays = dict(id=numpy.arange(nrows), amount=numpy.arange(nrows) * 0.25, name=numpy.array(names))
+        scenarios.append(("Columns of NumPy", lambda: tem.render(dict(rows=paulatemplate.Columns(arrays)))))
+    for label, func in scenarios:
+        assert func() == expected, "%s renders differently" % label
+        peak = peakmemory(func)[1]
+        print("%-18s %8.3f s  peak %7.1f MB" % (label, best(func), peak / 2 ** 20))
+
+
+def bench_strict(nrenders=20):
+    """Validating the variables of the books template, against rendering it, with and without the strict path."""
+    tem = paulatemplate.Paulatemplate(bookstemplate)
+    temv = books_data(20)
+    assert tem.render_strict(temv) == tem.render(temv)
+    broken = books_data(20)
+    del broken["books"][19]["chapters"][19]["sections"][19]["text"]
+    for label, func in (("render()", lambda: tem.render(temv)), ("validate()", lambda: tem.validate(temv)),
+                        ("render_strict()", lambda: tem.render_strict(temv)), ("render(), broken", lambda: tem.render(broken)),
+                        ("validate(), broken", lambda: tem.validate(broken))):
+        print("%-20s %8.2f ms" % (label, best(lambda: [func() for nr in range(nrenders)]) / nrenders * 1000))
+
+
+benchmarks = {
+    "compile": bench_compile,
+    "parallel": bench_parallel,
+    "lazy": bench_lazy,
+    "fragments": bench_fragments,
+    "tape": bench_tape,
+    "bytes": bench_bytes,
+    "autoescape": bench_autoescape,
+    "threads": bench_threads,
+    "whitespace": bench_whitespace,
+    "columns": bench_columns,
+    "strict": bench_strict,
+    }
+
+
+def scenario_compile_large(scale, backend):
+    """Compiling a 256 KB template."""
+    chunk = "<div>\n<h2>{=title}</h2>{?onsale <b>On sale!</b>}\n<ul>{#variants <li>{=size}: {=price}{/sep , }</li>}</ul>\n</div>\n"
+    jchunk = ("<div>\n<h2>{{title}}</h2>{% if onsale %}<b>On sale!</b>{% endif %}\n<ul>{% for v in variants %}<li>{{v.size}}: "
+              "{{v.price}}{% if not loop.last %}, {% endif %}</li>{% endfor %}</ul>\n</div>\n")
+    count = int(2 ** 18 * scale) // len(chunk) or 1
+    source, jsource = chunk * count, jchunk * count
+    return (lambda: paulatemplate.Paulatemplate(source, backend=backend)), (lambda: jinja2.Template(jsource)), None
+
+
+def scenario_compile_deep(scale, backend):
+    """Compiling conditions nested 2000 deep (Jinja2 can't nest that deep)."""
+    depth = int(2000 * scale) or 1
+    source = "{?c " * depth + "x" + "}" * depth
+    return (lambda: paulatemplate.Paulatemplate(source, backend=backend)), None, None
+
+
+def scenario_wide_rep(scale, backend):
+    """A Rep over 100000 rows with a few substitutions each."""
+    temv = dict(rows=[dict(id=nr, name="customer %d" % nr, amount=nr * 1.25) for nr in range(int(100000 * scale) or 1)])
+    tems = "<table>{#rows <tr><td>{=id}</td><td>{=name}</td><td>{=amount}</td></tr>\n}</table>"
+    jtems = "<table>{% for row in rows %}<tr><td>{{row.id}}</td><td>{{row.name}}</td><td>{{row.amount}}</td></tr>\n{% endfor %}</table>"
+    return render_scenario(tems, jtems, temv, backend)
+
+
+def scenario_deep_nesting(scale, backend):
+    """Reps nested 6 deep, with 5 items on every level (not scaled)."""
+    depth, width = 6, 5
+    tems = jtems = "{=x}"
+    for level in reversed(range(depth)):
+        tems = "{#l%d <%d>%s}" % (level, level, tems)
+        jtems = "{%% for i%d in %s.l%d %%}<%d>%s{%% endfor %%}" % (level, "i%d" % (level - 1) if level else "root", level, level, jtems)
+    jtems = jtems.replace("{{x}}", "{{i%d.x}}" % (depth - 1))
+    item = dict(x="leaf")
+    for level in reversed(range(depth)):
+        item = {"l%d" % level: [item] * width}
+    return render_scenario(tems, jtems, dict(item, root=item), backend)
+
+
+def scenario_sub_heavy(scale, backend):
+    """200 substitutions of different variables, in each of 500 rows."""
+    names = ["v%d" % nr for nr in range(200)]
+    row = dict((name, "value of %s" % name) for name in names)
+    temv = dict(rows=[row] * (int(500 * scale) or 1))
+    tems = "{#rows " + " ".join("{=%s}" % name for name in names) + "\n}"
+    jtems = "{% for row in rows %}" + " ".join("{{row.%s}}" % name for name in names) + "\n{% endfor %}"
+    return render_scenario(tems, jtems, temv, backend)
+
+
+def scenario_cond_heavy(scale, backend):
+    """20 conditions, half of them inverted, in each of 5000 rows."""
+    temv = dict(rows=[dict(("c%d" % nr, (row + nr) % 3 == 0) for nr in range(20)) for row in range(int(5000 * scale) or 1)])
+    tems = "{#rows " + "".join("{%s%s c%d}" % ("!" if nr % 2 else "?", "c%d" % nr, nr) for nr in range(20)) + "\n}"
+    jtems = ("{% for row in rows %}" + "".join("{%% if %srow.c%d %%}c%d{%% endif %%}" % ("not " if nr % 2 else "", nr, nr) for nr in range(20))
+             + "\n{% endfor %}")
+    return render_scenario(tems, jtems, temv, backend)
+
+
+def scenario_sep_heavy(scale, backend):
+    """A short list of 200000 items with a separator between them."""
+    temv = dict(items=[dict(x=nr) for nr in range(int(200000 * scale) or 1)])
+    tems = "[{#items {=x}{/sep , }}]"
+    jtems = "[{% for item in items %}{{item.x}}{% if not loop.last %}, {% endif %}{% endfor %}]"
+    return render_scenario(tems, jtems, temv, backend)
+
+
+def scenario_huge_literals(scale, backend):
+    """Ten literals of 1 MB, with substitutions between them."""
+    literal = "<p>" + "lorem ipsum " * int(2 ** 20 * scale / 12) + "</p>"
+    tems = "".join("{=x%d}%s" % (nr, literal) for nr in range(10))
+    jtems = "".join("{{x%d}}%s" % (nr, literal) for nr in range(10))
+    return render_scenario(tems, jtems, dict(("x%d" % nr, nr) for nr in range(10)), backend)
+
+
+def scenario_books(scale, backend):
+    """The nested books/chapters/sections template, 20 items on every level (formerly test_performance)."""
+    return render_scenario(bookstemplate, jinjabookstemplate, books_data(int(20 * scale ** (1 / 3.0)) or 1), backend)
+
+
+def render_scenario(tems, jtems, temv, backend):
+    """The operations of a scenario that renders 'tems' (and the Jinja2 template 'jtems') with the variables 'temv'."""
+    tem = paulatemplate.Paulatemplate(tems, backend=backend)
+    jtem = jinja2.Template(jtems) if jinja2 else None
+    return (lambda: tem.render(temv)), (lambda: jtem.render(temv)), temv
+
+
+scenarios = {
+    "compile_large": scenario_compile_large,
+    "compile_deep": scenario_compile_deep,
+    "wide_rep": scenario_wide_rep,
+    "deep_nesting": scenario_deep_nesting,
+    "sub_heavy": scenario_sub_heavy,
+    "cond_heavy": scenario_cond_heavy,
+    "sep_heavy": scenario_sep_heavy,
+    "huge_literals": scenario_huge_literals,
+    "books": scenario_books,
+    }
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+
+def percentile(ordered, fraction):
+    """The value at 'fraction' (0 to 1) of the sorted list 'ordered', by the nearest-rank method."""
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def measure(func, mintime=1.0, miniterations=5, maxiterations=1000):
+    """Time 'func' for at least 'mintime' seconds and 'miniterations' iterations, after a warmup call, and measure
+    the peak memory of one more call. Returns a dict of statistics; times are in seconds, sizes in bytes."""
+    result = func()
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < maxiterations and (len(latencies) < miniterations or time.perf_counter() - started < mintime):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    ordered = sorted(latencies)
+    output = len(result.encode("utf-8")) if isinstance(result, str) else 0
+    return dict(iterations=len(latencies), mean=sum(latencies) / len(latencies), min=ordered[0],
+                p50=percentile(ordered, 0.5), p90=percentile(ordered, 0.9), p99=percentile(ordered, 0.99),
+                throughput=len(latencies) / sum(latencies), output=output, peak_memory=peakmemory(func)[1])
+
+
+def run(names=None, scale=1.0, backend="codegen", mintime=1.0, compare_jinja2=True, file=sys.stdout):
+    """Run the scenarios 'names' (by default all of them) and return the results, printing a line for each."""
+    results = dict(version=paulatemplate.__version__, python=platform.python_version(), implementation=platform.python_implementation(),
+                   machine=platform.machine(), gil=sys._is_gil_enabled() if hasattr(sys, "_is_gil_enabled") else True,
+                   jinja2=jinja2.__version__ if jinja2 and compare_jinja2 else None, backend=backend, scale=scale,
+                   timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"), scenarios={})
+    print("%-14s %7s %10s %10s %10s %10s %10s %9s" % ("scenario", "iters", "ops/s", "p50", "p90", "p99", "peak", "jinja2"), file=file)
+    for name in names or scenarios:
+        func, jfunc, temv = scenarios[name](scale, backend)
+        stats = measure(func, mintime)
+        if jinja2 and compare_jinja2 and jfunc:
+            stats["jinja2"] = measure(jfunc, mintime)
+        results["scenarios"][name] = stats
+        print("%-14s %7d %10.1f %8.2f ms %8.2f ms %8.2f ms %7.1f MB %9s" % (
+            name, stats["iterations"], stats["throughput"], stats["p50"] * 1000, stats["p90"] * 1000, stats["p99"] * 1000,
+            stats["peak_memory"] / 2 ** 20, "%.2fx" % (stats["jinja2"]["p50"] / stats["p50"]) if "jinja2" in stats else "-"), file=file)
+    return results
+
+
+def compare(baseline, current, threshold=10.0, file=sys.stdout):
+    """Compare the p50 latency and the peak memory of every scenario in the results 'current' against 'baseline',
+    printing the changes. Returns the regressions: (scenario, metric, baseline, current) tuples for the changes
+    of more than 'threshold' percent for the worse."""
+    regressions = []
+    for setting in ("backend", "scale", "python"):
+        if baseline.get(setting) != current.get(setting):
+            print("Note: the %s differs: %s in the baseline, %s now" % (setting, baseline.get(setting), current.get(setting)), file=file)
+    print("%-14s %-12s %12s %12s %8s" % ("scenario", "metric", "baseline", "current", "change"), file=file)
+    for name, stats in sorted(current["scenarios"].items()):
+        if name not in baseline["scenarios"]:
+            print("%-14s (not in the baseline)" % name, file=file)
+            continue
+        for metric in ("p50", "peak_memory"):
+            old, new = baseline["scenarios"][name][metric], stats[metric]
+            change = (new - old) * 100.0 / old if old else 0.0
+            flag = change > threshold
+            if flag:
+                regressions.append((name, metric, old, new))
+            print("%-14s %-12s %12.6g %12.6g %+7.1f%%%s" % (name, metric, old, new, change, "  REGRESSION" if flag else ""), file=file)
+    return regressions
+
+
+def main(argv):
+    import argparse
+    if argv and argv[0] in benchmarks:
+        for name in argv:
+            print("\n== %s ==" % name)
+            benchmarks[name]()
+        return 0
+    parser = argparse.ArgumentParser(prog="python -m paulatemplate_bench", description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    cmd = commands.add_parser("run", help="run the benchmark scenarios")
+    cmd.add_argument("scenarios", nargs="*", help="the scenarios to run (default: all): %s" % ", ".join(scenarios))
+    cmd.add_argument("--json", help="write the results to this file")
+    cmd.add_argument("--quick", action="store_true", help="run the scenarios with a tenth of the data, briefly")
+    cmd.add_argument("--backend", default="codegen", choices=("codegen", "tree", "tape"))
+    cmd.add_argument("--no-jinja2", action="store_true", help="don't compare with Jinja2")
+    cmd = commands.add_parser("compare", help="compare results against a baseline")
+    cmd.add_argument("baseline")
+    cmd.add_argument("current")
+    cmd.add_argument("--threshold", type=float, default=10.0, help="the change in percent that counts as a regression (default: 10)")
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        unknown = [name for name in args.scenarios if name not in scenarios]
+        if unknown:
+            parser.error("unknown scenario: %s" % ", ".join(unknown))
+        results = run(args.scenarios, 0.1 if args.quick else 1.0, args.backend, 0.2 if args.quick else 1.0, not args.no_jinja2)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    print("%d regressions over %g%%" % (len(regressions), args.threshold))
+    return 1 if regressions else 0
+
+
+class Test(unittest.TestCase):
+    """Tests for the regression tracking: python -m unittest paulatemplate_bench"""
+
+    def test_percentile(self):
+        ordered = list(range(1, 11))
+        self.assertEqual([percentile(ordered, fraction) for fraction in (0.1, 0.3, 0.5, 0.9, 0.99, 1.0)], [1, 3, 5, 9, 10, 10])
+        self.assertEqual([percentile(ordered, fraction) for fraction in (0.0, 0.05, 0.11)], [1, 1, 2])
+        self.assertEqual(percentile([7], 0.5), 7)
+
+    def test_compare(self):
+        def results(**stats):
+            return dict(backend="codegen", scale=1.0, python="3", scenarios=dict(
+                (name, dict(p50=p50, peak_memory=peak)) for name, (p50, peak) in stats.items()))
+
+        baseline = results(a=(1.0, 1000), b=(2.0, 1000), c=(1.0, 0))
+        current = results(a=(1.05, 1200), b=(1.0, 1000), c=(1.0, 0), d=(1.0, 1))
+        out = io.StringIO()
+        self.assertEqual(compare(baseline, current, 10.0, out), [("a", "peak_memory", 1000, 1200)])
+        self.assertIn("d              (not in the baseline)", out.getvalue())
+        self.assertEqual(compare(baseline, current, 3.0, io.StringIO()), [("a", "p50", 1.0, 1.05), ("a", "peak_memory", 1000, 1200)])
+        out = io.StringIO()
+        self.assertEqual(compare(dict(baseline, backend="tape"), baseline, 10.0, out), [])
+        self.assertIn("Note: the backend differs: tape in the baseline, codegen now", out.getvalue())
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))